@@ -0,0 +1,253 @@
+"""Benchmarks for the dassort loop
+
+Generates a synthetic source tree (file mode, sub-directory mode or both), routes it
+across a few configs and times each stage of a cycle separately: scan, route, stability
+check, key extraction/build_path, transfer (using the fake copy protocol) and verify.
+Results are written out as json so they can be compared between runs.
+
+    python benchmarks/bench_dassort.py --sessions 200 --files 5 --file-size 65536 -o bench.json
+"""
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scanner import scan_source  # noqa: E402
+from util import (read_config, parse_router, check_stability, manifest_path, proc_loop,  # noqa: E402
+                  md5_checksum, get_listing_manifest)
+
+
+STAGES = ['scan', 'route', 'stability', 'path', 'transfer', 'verify']
+
+
+def make_sessions(source, n_sessions, n_files, file_size, mode, n_routes):
+    """Fills a source directory with synthetic sessions
+
+    Args:
+        source: directory to fill
+        n_sessions: number of sessions to make
+        n_files: number of data files per session (not counting the json)
+        file_size: size of each data file (bytes)
+        mode: 'file' for json files with matching data files, 'dir' for session sub-directories
+        n_routes: number of routes to spread the sessions across
+    """
+    data = os.urandom(file_size)
+    for i in range(n_sessions):
+        metadata = {
+            'SubjectName': 'mouse{}'.format(i % 7),
+            'SessionName': 'route{}'.format(i % n_routes)
+        }
+        if mode == 'dir':
+            session = os.path.join(source, 'session_{:05d}'.format(i))
+            os.makedirs(session)
+            names = [os.path.join(session, 'file{}.dat'.format(j)) for j in range(n_files)]
+            json_file = os.path.join(session, 'metadata.json')
+        else:
+            names = [os.path.join(source, 'session_{:05d}_file{}.dat'.format(i, j)) for j in range(n_files)]
+            json_file = os.path.join(source, 'session_{:05d}.json'.format(i))
+        for name in names:
+            with open(name, 'wb') as f:
+                f.write(data)
+        with open(json_file, 'w') as f:
+            json.dump(metadata, f)
+
+
+def make_configs(config_dir, destination, n_routes):
+    """Writes one config per route plus a router, and reads them back in
+
+    Args:
+        config_dir: where to put the yaml files
+        destination: destination root
+        n_routes: number of routes
+    Returns:
+        configs: dictionary of yaml name -> base config
+        router: router config
+    """
+    names = []
+    for i in range(n_routes):
+        name = 'route{}.yaml'.format(i)
+        with open(os.path.join(config_dir, name), 'w') as f:
+            f.write('dassort:\n'
+                    '  json:\n'
+                    '    keys: [SubjectName]\n'
+                    '    map: [subject]\n'
+                    '    default: [unsorted]\n'
+                    '  path: ${root}/route%d/${subject}/${sub_folder}\n' % i)
+        names.append(name)
+
+    with open(os.path.join(config_dir, 'router.yaml'), 'w') as f:
+        f.write('router:\n'
+                '  key: SessionName\n'
+                '  filter: [%s]\n'
+                '  exact: True\n'
+                '  lowercase: True\n'
+                '  invert: False\n'
+                '  files: [%s]\n' % (', '.join(['route%d' % i for i in range(n_routes)]), ', '.join(names)))
+
+    configs = {}
+    for name in names:
+        base_config, _, _ = read_config(os.path.join(config_dir, name), destination)
+        configs[name] = base_config
+    _, _, router = read_config(os.path.join(config_dir, 'router.yaml'), destination)
+
+    return configs, router
+
+
+def run_cycle(source, configs, router, remote_options, jobs):
+    """Runs one cycle of the dassort loop, timing each stage
+
+    Returns:
+        timings: dictionary of stage -> seconds
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    scan = scan_source(source)
+    timings['scan'] = time.perf_counter() - start
+
+    listing_total = scan['dirs'] + scan['json']
+
+    start = time.perf_counter()
+    router_status = parse_router(router, scan['dirs_json'], scan['json'])
+    timings['route'] = time.perf_counter() - start
+
+    # first pass takes the snapshot, second one (with no settle window) finds them stable
+    tracker = {}
+    check_stability(tracker, listing_total, 0, scan=scan)
+    start = time.perf_counter()
+    ready = check_stability(tracker, listing_total, 0, scan=scan)
+    timings['stability'] = time.perf_counter() - start
+
+    routes = []
+    for status in sorted(set([_ for _ in router_status if _ is not None])):
+        new_listing = [lst for (lst, st) in zip(listing_total, router_status) if st == status]
+        routes.append((new_listing, configs[router['files'][status]]))
+
+    start = time.perf_counter()
+    for new_listing, base_config in routes:
+        for proc in new_listing:
+            manifest_path(proc, ready[proc][1], base_config)
+    timings['path'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for new_listing, base_config in routes:
+        proc_loop(listing=new_listing,
+                  base_dict=base_config,
+                  dry_run=False,
+                  delete=False,
+                  remote_options=remote_options,
+                  tracker=tracker,
+                  settle_time=0,
+                  jobs=jobs,
+                  scan=scan)
+    timings['transfer'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for proc in listing_total:
+        for f in get_listing_manifest(proc, scan=scan)[0]:
+            with open(f, 'rb') as f_check:
+                md5_checksum(f_check)
+    timings['verify'] = time.perf_counter() - start
+
+    return timings
+
+
+def summarize(runs):
+    return {stage: {'min': min([r[stage] for r in runs]),
+                    'median': statistics.median([r[stage] for r in runs]),
+                    'runs': [r[stage] for r in runs]}
+            for stage in STAGES}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--sessions', '-n', type=click.IntRange(1, None), default=100)
+@click.option('--files', '-f', type=click.IntRange(1, None), default=4, help='Data files per session')
+@click.option('--file-size', type=click.IntRange(0, None), default=2**16, help='Bytes per data file')
+@click.option('--mode', type=click.Choice(['file', 'dir', 'both']), default='both')
+@click.option('--routes', type=click.IntRange(1, None), default=3)
+@click.option('--latency', type=float, default=0.0, help='Simulated per-file latency (s)')
+@click.option('--bandwidth', type=float, default=None, help='Simulated bandwidth (bytes/s)')
+@click.option('--jobs', '-j', type=click.IntRange(1, None), default=1)
+@click.option('--repeat', '-r', type=click.IntRange(1, None), default=3)
+@click.option('--output', '-o', type=click.Path(), default=None, help='Where to write the json results')
+@click.option('--keep', is_flag=True, help='Keep the synthetic tree around')
+def bench(sessions, files, file_size, mode, routes, latency, bandwidth, jobs, repeat, output, keep):
+    """Time each stage of the dassort loop on a synthetic source tree"""
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+
+    remote_options = {
+        'copy_protocol': 'fake',
+        'host': 'fake',
+        'user': 'fake',
+        'cmd_host': 'fake',
+        'latency': latency,
+        'bandwidth': bandwidth
+    }
+
+    modes = ['file', 'dir'] if mode == 'both' else [mode]
+    results = {
+        'params': {
+            'sessions': sessions,
+            'files': files,
+            'file_size': file_size,
+            'routes': routes,
+            'latency': latency,
+            'bandwidth': bandwidth,
+            'jobs': jobs,
+            'repeat': repeat
+        },
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': {}
+    }
+
+    for use_mode in modes:
+        root = tempfile.mkdtemp(prefix='dassort-bench-')
+        try:
+            source = os.path.join(root, 'source')
+            config_dir = os.path.join(root, 'configs')
+            os.makedirs(source)
+            os.makedirs(config_dir)
+            make_sessions(source, sessions, files, file_size, use_mode, routes)
+            configs, router = make_configs(config_dir, os.path.join(root, 'destination'), routes)
+
+            runs = [run_cycle(source, configs, router, remote_options, jobs) for _ in range(repeat)]
+            results['results'][use_mode] = summarize(runs)
+
+            click.echo('%s mode, %d sessions:' % (use_mode, sessions))
+            for stage in STAGES:
+                click.echo('  %-10s %10.4f s' % (stage, results['results'][use_mode][stage]['median']))
+        finally:
+            if keep:
+                click.echo('Kept ' + root)
+            else:
+                shutil.rmtree(root)
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,229 @@
+import hashlib
+import logging
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from transport import ssh_options
+
+BLOCK_SIZE = 2**20
+
+
+def get_chunks(size, chunk_size):
+    """Splits a file into (offset, length) chunks, chunk_size is rounded to a whole number
+    of blocks so remote dd can seek to it"""
+    chunk_size = max(chunk_size // BLOCK_SIZE, 1) * BLOCK_SIZE
+    return [(offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)] or [(0, 0)]
+
+
+def chunk_md5(fd, offset, length):
+    """md5 of part of a file"""
+    md5 = hashlib.md5()
+    end = offset + length
+    while offset < end:
+        data = os.pread(fd, min(BLOCK_SIZE, end - offset), offset)
+        if not data:
+            break
+        md5.update(data)
+        offset += len(data)
+    return md5.hexdigest()
+
+
+def run_chunks(fun, chunks, jobs, retries, name):
+    """Runs fun on every chunk in a thread pool, retrying only the ones that fail
+
+    Args:
+        fun: function taking a chunk and returning True if it worked
+        chunks: list of (offset, length)
+        jobs: number of chunks to send at once
+        retries: number of times to retry failed chunks
+        name: file name for logging
+    Returns:
+        success: True if every chunk made it
+    """
+    todo = chunks
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                logging.info('Retrying %d chunks of %s (attempt %d)' % (len(todo), name, attempt + 1))
+            status = list(pool.map(fun, todo))
+            todo = [chunk for chunk, st in zip(todo, status) if not st]
+            if len(todo) == 0:
+                return True
+
+    logging.info('%d chunks of %s FAILED' % (len(todo), name))
+    return False
+
+
+def chunked_copy_local(f, new_path, chunk_size=64 * 2**20, jobs=4, retries=3, throttle=None):
+    """Copies a big file in chunks, in parallel. Each chunk is hashed on the way in and
+    read back to check it, the file is written to a temporary name and renamed once every
+    chunk is good.
+
+    Args:
+        f: file to copy
+        new_path: destination directory
+        chunk_size: bytes per chunk
+        jobs: number of chunks to copy at once
+        retries: number of times to retry failed chunks
+        throttle: function called with the number of bytes before they're written, shared by every chunk
+    Returns:
+        nbytes: number of bytes copied, None if it failed
+    """
+    new_file = os.path.join(new_path, os.path.basename(f))
+    tmp_file = new_file + '.dassort-tmp'
+    size = os.path.getsize(f)
+    chunks = get_chunks(size, chunk_size)
+    start_time = time.time()
+
+    fd_in = os.open(f, os.O_RDONLY)
+    fd_out = os.open(tmp_file, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def copy_chunk(chunk):
+        offset, length = chunk
+        try:
+            md5 = hashlib.md5()
+            pos = offset
+            while pos < offset + length:
+                data = os.pread(fd_in, min(BLOCK_SIZE, offset + length - pos), pos)
+                if not data:
+                    return False
+                md5.update(data)
+                if throttle is not None:
+                    throttle(len(data))
+                os.pwrite(fd_out, data, pos)
+                pos += len(data)
+            return chunk_md5(fd_out, offset, length) == md5.hexdigest()
+        except OSError as error:
+            logging.info('Chunk at %d of %s failed: %s' % (offset, f, str(error)))
+            return False
+
+    try:
+        os.ftruncate(fd_out, size)
+        success = run_chunks(copy_chunk, chunks, jobs, retries, os.path.basename(f))
+        if success:
+            os.fsync(fd_out)
+    finally:
+        os.close(fd_in)
+        os.close(fd_out)
+
+    if not success:
+        return None
+
+    os.replace(tmp_file, new_file)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    logging.info('Copied %s in %d chunks (%.1f MB in %.2f s, %.1f MB/s)' %
+                 (os.path.basename(f), len(chunks), size / 1e6, elapsed, size / 1e6 / elapsed))
+
+    return size
+
+
+def chunked_copy_remote(f, new_path, remote_options, chunk_size=64 * 2**20, jobs=4, retries=3, throttle=None):
+    """Sends a big file to a remote host in chunks over (multiplexed) ssh, in parallel.
+    Chunks are hashed on their way out and written with dd into a temporary file, then checked
+    in one batched command, and only the ones that don't match get sent again. If an earlier
+    attempt left the temporary file behind, chunks already in place are left alone. Once
+    everything matches the file is renamed.
+
+    Args:
+        f: file to copy
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+        chunk_size: bytes per chunk
+        jobs: number of chunks to send at once
+        retries: number of times to retry failed chunks
+        throttle: function called with the number of bytes before they're sent, shared by every chunk
+    Returns:
+        nbytes: number of bytes copied, None if it failed
+    """
+    new_file = os.path.join(new_path, os.path.basename(f))
+    tmp_file = new_file + '.dassort-tmp'
+    size = os.path.getsize(f)
+    chunks = get_chunks(size, chunk_size)
+    start_time = time.time()
+
+    ssh_cmd = "ssh %s %s@%s" % (ssh_options(remote_options), remote_options['user'], remote_options['host'])
+
+    def remote(cmd, **kwargs):
+        return subprocess.run(ssh_cmd + " '" + cmd + "'", shell=True, **kwargs)
+
+    fd_in = os.open(f, os.O_RDONLY)
+
+    # filled in as the chunks go out
+    local_md5 = {}
+
+    try:
+        def check_chunks(todo):
+            # check all of them in one round trip
+            cmd = ' ; '.join(['dd if="%s" bs=%d skip=%d count=%d status=none 2>/dev/null | md5sum' %
+                              (tmp_file, BLOCK_SIZE, offset // BLOCK_SIZE, -(-length // BLOCK_SIZE))
+                              for offset, length in todo])
+            result = remote(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            digests = [line.split()[0] for line in result.stdout.decode().splitlines() if line.strip()]
+            if len(digests) != len(todo):
+                return [False for _ in todo]
+            return [digest == local_md5.get(chunk) for digest, chunk in zip(digests, todo)]
+
+        def send_chunk(chunk):
+            offset, length = chunk
+            proc = subprocess.Popen(ssh_cmd + " 'dd of=\"%s\" bs=%d seek=%d conv=notrunc status=none'" %
+                                    (tmp_file, BLOCK_SIZE, offset // BLOCK_SIZE),
+                                    shell=True, stdin=subprocess.PIPE)
+            try:
+                md5 = hashlib.md5()
+                pos = offset
+                while pos < offset + length:
+                    data = os.pread(fd_in, min(BLOCK_SIZE, offset + length - pos), pos)
+                    if not data:
+                        break
+                    md5.update(data)
+                    if throttle is not None:
+                        throttle(len(data))
+                    proc.stdin.write(data)
+                    pos += len(data)
+                proc.stdin.close()
+                if pos == offset + length:
+                    local_md5[chunk] = md5.hexdigest()
+            except (OSError, BrokenPipeError) as error:
+                logging.info('Chunk at %d of %s failed: %s' % (offset, f, str(error)))
+            return proc.wait() == 0
+
+        # make sure the temporary file is the right size, keeping any chunks already there
+        result = remote('mkdir -p "%s" && if [ -e "%s" ]; then echo resume; fi && touch "%s" && truncate -s %d "%s"' %
+                        (new_path, tmp_file, tmp_file, size, tmp_file), stdout=subprocess.PIPE)
+        if result.returncode != 0:
+            return None
+
+        # a fresh file has nothing worth checking, only an earlier attempt can have left chunks behind
+        if 'resume' in result.stdout.decode(errors='replace'):
+            local_md5.update({chunk: chunk_md5(fd_in, chunk[0], chunk[1]) for chunk in chunks})
+            todo = [chunk for chunk, ok in zip(chunks, check_chunks(chunks)) if not ok]
+            logging.info('%d of %d chunks of %s already in place' %
+                         (len(chunks) - len(todo), len(chunks), os.path.basename(f)))
+        else:
+            todo = chunks
+
+        for attempt in range(retries + 1):
+            if len(todo) == 0:
+                break
+            if attempt > 0:
+                logging.info('Retrying %d chunks of %s (attempt %d)' % (len(todo), os.path.basename(f), attempt + 1))
+            with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+                list(pool.map(send_chunk, todo))
+            todo = [chunk for chunk, ok in zip(todo, check_chunks(todo)) if not ok]
+    finally:
+        os.close(fd_in)
+
+    if len(todo) > 0:
+        logging.info('%d chunks of %s FAILED' % (len(todo), os.path.basename(f)))
+        return None
+
+    if remote('mv -f "%s" "%s"' % (tmp_file, new_file)).returncode != 0:
+        return None
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    logging.info('Copied %s in %d chunks (%.1f MB in %.2f s, %.1f MB/s)' %
+                 (os.path.basename(f), len(chunks), size / 1e6, elapsed, size / 1e6 / elapsed))
+
+    return size
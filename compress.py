@@ -0,0 +1,217 @@
+import logging
+import os
+import subprocess
+import time
+import zlib
+from functools import lru_cache
+import metrics
+from hashing import new_hasher
+from transport import ssh_options
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# codec -> (suffix for stored files, command to decompress on the other end)
+CODECS = {
+    'gzip': ('.gz', 'gzip -dc'),
+    'zstd': ('.zst', 'zstd -dcq')
+}
+
+# already compressed, not worth trying
+INCOMPRESSIBLE = ('.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.7z', '.rar', '.mp4', '.avi', '.mkv', '.mov',
+                  '.mp3', '.jpg', '.jpeg', '.png', '.gif')
+
+SAMPLE_SIZE = 2**16
+
+# anything that can go wrong setting up a compressor (a bad level, mostly)
+if zstandard is not None:
+    COMPRESSION_ERRORS = (ValueError, zlib.error, zstandard.ZstdError)
+else:
+    COMPRESSION_ERRORS = (ValueError, zlib.error)
+
+
+def resolve_codec(codec):
+    """zstd needs the zstandard package installed, otherwise we fall back to gzip"""
+    if codec is None:
+        return None
+    if codec == 'zstd' and zstandard is None:
+        return 'gzip'
+    if codec not in CODECS:
+        raise ValueError('Unknown compression ' + str(codec))
+    return codec
+
+
+def new_compressor(codec, level=None):
+    """Gets a streaming compressor (with compress and flush) for a codec. If zstd fell back to gzip
+    the level is dropped, zstd levels go way past what gzip takes"""
+    resolved = resolve_codec(codec)
+    if resolved != codec:
+        level = None
+    if resolved == 'zstd':
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    # wbits 31 gets us a gzip header, so gzip -d on the other end can read it
+    return zlib.compressobj(6 if level is None else min(max(level, -1), 9), zlib.DEFLATED, 31)
+
+
+def sample_ratio(f, codec, level=None, sample_size=SAMPLE_SIZE):
+    """Compresses a few samples (start, middle and end) of a file to see how well it compresses
+
+    Args:
+        f: file to check
+        codec: gzip or zstd
+        level: compression level
+        sample_size: bytes per sample
+    Returns:
+        ratio: compressed size over original size for the samples
+    """
+    size = os.path.getsize(f)
+    offsets = sorted(set([0, max(size // 2 - sample_size // 2, 0), max(size - sample_size, 0)]))
+    raw = 0
+    compressed = 0
+    with open(f, 'rb') as f_in:
+        for offset in offsets:
+            f_in.seek(offset)
+            data = f_in.read(sample_size)
+            compressor = new_compressor(codec, level)
+            raw += len(data)
+            compressed += len(compressor.compress(data)) + len(compressor.flush())
+    return compressed / float(max(raw, 1))
+
+
+@lru_cache(maxsize=4096)
+def _worth_it(f, size, mtime, codec, level, max_ratio):
+    # size and mtime are only here so a changed file gets checked again
+    try:
+        ratio = sample_ratio(f, codec, level)
+    except COMPRESSION_ERRORS as error:
+        # a bad setting shouldn't take the daemon down, the file just goes as is
+        logging.info('Could not compress %s with %s, sending it as is: %s' % (os.path.basename(f), codec, str(error)))
+        return False
+    logging.info('Sample of %s compresses to %.0f%% with %s' % (os.path.basename(f), ratio * 100, codec))
+    return ratio <= max_ratio
+
+
+def use_compression(f, remote_options):
+    """Should this file be compressed on its way out? Only if compression is turned on, the file's
+    big enough, isn't a format that's already compressed, and a sample of it compresses well
+
+    Args:
+        f: file to copy
+        remote_options: remote configuration from read_config
+    Returns:
+        codec: codec to use, None to send it as is
+    """
+    codec = resolve_codec(remote_options.get('compression'))
+    if codec is None or remote_options['copy_protocol'] != 'scp':
+        return None
+    if f.endswith('.json') or f.lower().endswith(INCOMPRESSIBLE):
+        return None
+
+    stat = os.stat(f)
+    if stat.st_size < (remote_options.get('compression_min_size') or 0):
+        return None
+
+    return codec if _worth_it(f, stat.st_size, stat.st_mtime_ns, codec, remote_options.get('compression_level'),
+                              remote_options.get('compression_max_ratio', 0.9)) else None
+
+
+def stored_name(f, codec, remote_options):
+    """Name of the file on the other end, with the codec's suffix if we're storing it compressed"""
+    if codec is not None and remote_options.get('compression_mode') == 'stored':
+        return os.path.basename(f) + CODECS[codec][0]
+    return os.path.basename(f)
+
+
+def compress_command(f, new_path, remote_options, codec):
+    """Command that takes a compressed stream on stdin and either unpacks it (compression_mode wire)
+    or keeps it as is (compression_mode stored), via a temporary file
+
+    Args:
+        f: file to copy
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+        codec: gzip or zstd
+    Returns:
+        cp_cmd: command string
+    """
+    new_file = os.path.join(new_path, stored_name(f, codec, remote_options))
+    tmp_file = new_file + '.dassort-tmp'
+    if remote_options.get('compression_mode') == 'stored':
+        write_cmd = 'cat'
+    else:
+        write_cmd = CODECS[codec][1]
+    return "ssh %s %s@%s '%s > \"%s\" && mv -f \"%s\" \"%s\"'" % (
+        ssh_options(remote_options), remote_options['user'], remote_options['host'], write_cmd, tmp_file,
+        tmp_file, new_file)
+
+
+def send_compressed(f, cp_cmd, codec, level=None, algorithm='md5', throttle=None, block_size=2**20):
+    """Compresses a file as it streams into a command (see compress_command). The original is
+    hashed on the way through.
+
+    Args:
+        f: file to send
+        cp_cmd: command to pipe the compressed stream into
+        codec: gzip or zstd
+        level: compression level
+        algorithm: hash algorithm to use (see hashing.new_hasher)
+        throttle: function called with the number of (compressed) bytes before they're sent
+        block_size: read size
+    Returns:
+        nbytes: number of bytes in the original
+        wire_bytes: number of bytes actually sent
+        digest: hex digest of the original
+    """
+    start_time = time.time()
+    compress_time = 0.0
+    hasher = new_hasher(algorithm)
+    compressor = new_compressor(codec, level)
+    nbytes = 0
+    wire_bytes = 0
+
+    def send(data):
+        if throttle is not None and data:
+            throttle(len(data))
+        proc.stdin.write(data)
+        return len(data)
+
+    proc = subprocess.Popen(cp_cmd, shell=True, stdin=subprocess.PIPE)
+    try:
+        with open(f, 'rb') as f_in:
+            while True:
+                data = f_in.read(block_size)
+                if not data:
+                    break
+                hasher.update(data)
+                nbytes += len(data)
+                compress_start = time.time()
+                data = compressor.compress(data)
+                compress_time += time.time() - compress_start
+                wire_bytes += send(data)
+        compress_start = time.time()
+        data = compressor.flush()
+        compress_time += time.time() - compress_start
+        wire_bytes += send(data)
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        status = proc.wait()
+
+    if status != 0:
+        raise OSError('Compressed copy exited with ' + str(status))
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    ratio = nbytes / float(max(wire_bytes, 1))
+    logging.info('Copied %s with %s, %.1fx (%.1f MB -> %.1f MB, %.2f s compressing, %.2f s total)' %
+                 (os.path.basename(f), codec, ratio, nbytes / 1e6, wire_bytes / 1e6, compress_time, elapsed))
+
+    metrics.inc('dassort_compression_bytes_total', nbytes, codec=codec, stage='original')
+    metrics.inc('dassort_compression_bytes_total', wire_bytes, codec=codec, stage='compressed')
+    metrics.observe('dassort_compression_seconds', compress_time, codec=codec)
+    metrics.observe('dassort_compression_ratio', ratio, codec=codec)
+
+    return nbytes, wire_bytes, hasher.hexdigest()
@@ -3,126 +3,362 @@ import click
 import time
 import sys
 import logging
+import multiprocessing
+import metrics
+import tracing
+import cProfile
 from glob import glob
-from util import proc_loop, read_config, parse_router
+from util import proc_routes, read_config, freeze_config, parse_router, prune_json_index, prune_present
+from scanner import scan_source, merge_scans
+from hashing import set_hash_jobs, load_hash_cache, save_hash_cache
+from journal import open_journal, close_journal
+from transport import close_transports
+from triggers import set_trigger_options, close_triggers
+from scheduler import next_retry, retry_report, write_retry_report
+from watch import inotify_available, init_watcher, wait_for_events, close_watcher
 from copy import deepcopy
+from itertools import cycle
 
 
-@click.command()
-@click.option('--source', '-s', type=click.Path(exists=True), envvar='DASSORT_SOURCE', default=os.getcwd())
-@click.option('--destination', '-d', type=str, envvar='DASSORT_DESTINATION', default=os.path.join(os.getcwd(), 'tmp'))
-@click.option('--wait-time', '-w', type=click.IntRange(2, None), default=2)
-@click.option('--max-time', '-m', type=float, default=600)
-@click.option('--dry-run', type=bool, is_flag=True)
-@click.option('--copy-protocol', '-p', type=str, default='scp')
-@click.option('--delete', type=bool, is_flag=True)
-@click.option('--remote-host', '-r', type=str, envvar='DASSORT_HOST', default='transfer.rc.hms.harvard.edu')
-@click.option('--cmd-host', '-c', type=str, envvar='DASSORT_CMDHOST', default='o2.hms.harvard.edu')
-@click.option('--remote-user', '-u', type=str, envvar='DASSORT_USER', default='johanedoe')
-def dassort(source, destination, wait_time, max_time, dry_run, copy_protocol, delete, remote_host, cmd_host, remote_user):
-    """Main outer loop for watching files
+def load_source(source, destination, remote_defaults, workers=1):
+    """Reads the configs (and router, if there is one) in a source directory
 
+    Args:
+        source: source directory
+        destination: default destination
+        remote_defaults: remote configuration to use when a config doesn't have one
+        workers: number of worker processes, each one gets an even share of every bandwidth cap
+    Returns:
+        source_config: dictionary with the 'source', its 'configs' (list of (yaml name, base config,
+                       remote config)), 'router' (None if there isn't one), route 'weights' and the
+                       'signature' of the yaml files it came from (see config_signature)
     """
 
     # up front make sure we have a dassort.yaml file in the
     # source directory, otherwise we don't have much to work with!
 
-    wait_time = float(wait_time)
-    ymls = glob(os.path.join(source, '*.yaml'))
+    signature = config_signature(source)
+    ymls = sorted(signature.keys())
 
     configs = []
     router = None
 
-    remote_defaults = {
-        'user': remote_user,
-        'host': remote_host,
-        'cmd_host': cmd_host
-    }
-
     for yml in ymls:
         (base_config,
          remote_config,
          router_config) = read_config(yml,
                                       destination,
-                                      host=remote_host,
-                                      user=remote_user,
-                                      cmd_host=cmd_host,
-                                      copy_protocol=copy_protocol)
+                                      host=remote_defaults['host'],
+                                      user=remote_defaults['user'],
+                                      cmd_host=remote_defaults['cmd_host'],
+                                      copy_protocol=remote_defaults['copy_protocol'],
+                                      bwlimit=remote_defaults['bwlimit'],
+                                      hash_algorithm=remote_defaults['hash'])
 
         if (router_config is not None
             and len(router_config['key']) > 0
             and len(router_config['files']) > 0):
             router = router_config
         elif base_config is not None and remote_config is None:
-            configs.append((os.path.basename(yml), base_config, remote_defaults))
+            configs.append((os.path.basename(yml), base_config, worker_share(remote_defaults, workers)))
         elif base_config is not None:
-            configs.append((os.path.basename(yml), base_config, remote_config))
+            configs.append((os.path.basename(yml), base_config, worker_share(remote_config, workers)))
         else:
             pass
             #raise RuntimeError('Yaml misspecification')
 
+    if len(configs) == 0:
+        raise RuntimeError('No configuration file found in ' + source + '!')
+
+    # routes are named by source and yaml file, so every source gets its turn in the scheduler
     if router is not None:
-        has_router = True
+        weights = {(source, fname): weight for fname, weight in zip(router['files'], cycle(router['weights']))}
     else:
-        has_router = False
+        weights = {}
 
-    if len(configs) == 0:
-        raise RuntimeError('No configuration file found!')
+    return {
+        'source': source,
+        'configs': configs,
+        'router': router,
+        'weights': weights,
+        'signature': signature
+    }
+
+
+def worker_share(remote_config, workers):
+    """Splits a remote config's bandwidth cap between the worker processes, they all cap their own
+    transfers and may well be sending to the same host"""
+    if workers == 1 or not remote_config.get('bwlimit'):
+        return remote_config
+    return freeze_config(dict(remote_config, bwlimit=remote_config['bwlimit'] / workers))
+
+
+def config_signature(source, scan=None):
+    """The yaml files in a source directory along with their mtime and size, so we can tell when
+    any of them change
+
+    Args:
+        source: source directory
+        scan: scan of the source directory from scan_source, saves us going to the filesystem
+    Returns:
+        signature: dictionary of yaml file -> (mtime, size)
+    """
+    if scan is not None:
+        return {f: (stat.st_mtime_ns, stat.st_size) for f, stat in scan['stat'].items()
+                if f.endswith('.yaml') and os.path.dirname(f) == source}
+
+    signature = {}
+    for yml in glob(os.path.join(source, '*.yaml')):
+        try:
+            stat = os.stat(yml)
+        except OSError:
+            continue
+        signature[yml] = (stat.st_mtime_ns, stat.st_size)
+
+    return signature
 
-    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
-                        format="[%(asctime)s]: %(message)s",
-                        datefmt="%Y-%m-%d %H:%M:%S")
+
+def reload_source(source_config, scan, destination, remote_defaults, workers=1):
+    """Reads a source directory's configs again if any of the yaml files changed. The new configs
+    only get swapped in once they've all been read, so if something's wrong (say a file is
+    half-written) we log it and keep going with the old ones.
+
+    Args:
+        source_config: source configuration from load_source
+        scan: scan of the source directory from scan_source
+        destination: default destination
+        remote_defaults: remote configuration to use when a config doesn't have one
+        workers: number of worker processes (see load_source)
+    Returns:
+        source_config: the new source configuration, or the old one if nothing changed or it didn't work
+    """
+    signature = config_signature(source_config['source'], scan=scan)
+    if signature == source_config['signature']:
+        return source_config
+
+    logging.info('Configuration changed in ' + source_config['source'] + ', reloading')
+    try:
+        new_config = load_source(source_config['source'], destination, remote_defaults, workers=workers)
+    except Exception as error:
+        logging.info('Could not reload configuration, keeping the old one: ' + str(error))
+        source_config = dict(source_config)
+        source_config['signature'] = signature
+        return source_config
+
+    logging.info('Loaded ' + str(len(new_config['configs'])) + ' configs from ' + source_config['source'])
+    return new_config
+
+
+def source_routes(source_config, scan, active=None, settled=None):
+    """Splits a source directory's sessions between its routes
+
+    Args:
+        source_config: source configuration from load_source
+        scan: scan of the source directory from scan_source
+        active: if given, only route these sessions
+        settled: set that sessions going nowhere (no route, or no config for it) get added to, so they
+                 aren't routed again until they change
+    Returns:
+        routes: list of routes for proc_routes
+    """
+    source = source_config['source']
+    configs = source_config['configs']
+    router = source_config['router']
+
+    listing_json = scan['json']
+    listing_dirs = scan['dirs']
+    listing_dirs_json = scan['dirs_json']
+
+    if active is not None:
+        listing_json = [js for js in listing_json if js in active]
+        listing_dirs_json = [jsons for d, jsons in zip(listing_dirs, listing_dirs_json) if d in active]
+        listing_dirs = [d for d in listing_dirs if d in active]
+
+    listing_total = listing_dirs + listing_json
+
+    routes = []
+
+    if router is not None:
+
+        router_status = parse_router(router, listing_dirs_json, listing_json)
+        iter_status = set([_ for _ in router_status if _ is not None])
+        for proc, status in zip(listing_total, router_status):
+            if status is None:
+                metrics.inc('dassort_router_hits_total', route='none', source=source)
+                if settled is not None:
+                    settled.add(proc)
+            else:
+                metrics.inc('dassort_router_hits_total', route=router['files'][status], source=source)
+        for status in sorted(iter_status):
+            new_listing = [lst for (lst, st) in zip(listing_total, router_status) if st == status]
+            fname = router['files'][status]
+            use_config = [(cfg[1], cfg[2]) for cfg in configs if cfg[0] == fname]
+
+            if len(use_config) == 0:
+                if settled is not None:
+                    settled.update(new_listing)
+                continue
+            routes.append({
+                'name': (source, fname),
+                'listing': new_listing,
+                'base_dict': use_config[0][0],
+                'remote_options': use_config[0][1]
+            })
+    else:
+        routes.append({
+            'name': (source, configs[0][0]),
+            'listing': listing_total,
+            'base_dict': configs[0][1],
+            'remote_options': configs[0][2]
+        })
+
+    return routes
+
+
+def worker_file(file, worker):
+    """Gives each worker process its own copy of a file (metrics, hash cache), keeping the extension"""
+    if file is None:
+        return None
+    root, ext = os.path.splitext(file)
+    return root + '.' + str(worker) + ext
+
+
+def watch_sources(sources, settings):
+    """Main outer loop for watching files. Every source is scanned each cycle, and the sessions from
+    all of them share one scheduler, worker pool and set of per-host transfer slots. Configs are
+    reloaded between cycles whenever their yaml files change.
+
+    Args:
+        sources: list of source directories
+        settings: dictionary of options from the command line
+    """
+
+    wait_time = settings['wait_time']
+    max_time = settings['max_time']
+    settle_time = settings['settle_time']
+    metrics_file = settings['metrics_file']
+    profile_dir = settings['profile_dir']
+
+    destination = settings['destination']
+    remote_defaults = settings['remote_defaults']
+    workers = settings['workers']
+
+    source_configs = [load_source(source, destination, remote_defaults, workers=workers) for source in sources]
 
     # enter the main loop to watch directories
 
     sleep_time = deepcopy(wait_time)
 
+    # stability tracker is kept between cycles, so sessions settle while we sleep
+    stability = {}
+
+    # last cycle's scans, and sessions we're finished with (until they change)
+    scans = [None for _ in sources]
+    settled = set()
+
+    # sessions that keep failing back off on their own (and end up quarantined)
+    retries = {}
+
+    if settings['journal_file'] is not None:
+        journal = open_journal(settings['journal_file'])
+    else:
+        journal = None
+
+    set_hash_jobs(settings['hash_jobs'])
+    if settings['hash_cache'] is not None:
+        load_hash_cache(settings['hash_cache'])
+
+    set_trigger_options(jobs=settings['trigger_jobs'], timeout=settings['trigger_timeout'],
+                        retries=settings['trigger_retries'])
+
+    if settings['metrics_port'] is not None:
+        metrics.start_http_server(settings['metrics_port'])
+
+    if settings['trace_file'] is not None:
+        tracing.start_tracing(settings['trace_file'])
+
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+    cycle_count = 0
+
+    watcher = None
+    if settings['watch_mode'] == 'inotify' and inotify_available():
+        watcher = init_watcher(sources)
+    elif settings['watch_mode'] == 'inotify':
+        logging.info('inotify not available, falling back to polling')
+
     while True:
         try:
+            cycle_count += 1
+            cycle_start = time.time()
+            if profile_dir is not None:
+                # only sees the main thread, transfers with --jobs > 1 run elsewhere
+                profiler = cProfile.Profile()
+                profiler.enable()
+
             # gather all json files, and now figure out which files are associated with which json files
 
-            listing = [os.path.join(source, f)
-                       for f in sorted(os.listdir(source)) if os.path.isfile(f)]
-            listing_json = [f for f in listing if f.endswith('.json')]
-            listing_dirs_tmp = [os.path.join(source, f) for f
-                                in sorted(os.listdir(source)) if os.path.isdir(f)]
-            listing_dirs = []
-            listing_dirs_json = []
-            # each json file becomes a key, find any associated files...
-            # if any sub directories have json files, let 'er rip
-
-            for dir in listing_dirs_tmp:
-                dir_listing = os.listdir(dir)
-                dir_json = [os.path.join(dir, f) for f in dir_listing if f.endswith('.json')]
-                if len(dir_json) > 0:
-                    listing_dirs.append(dir)
-                    listing_dirs_json.append(dir_json)
-
-            listing_total = listing_dirs + listing_json
-
-            if has_router:
-
-                router_status = parse_router(router, listing_dirs_json, listing_json)
-                proc_count = 0
-                iter_status = set([_ for _ in router_status if _ is not None])
-                for status in iter_status:
-                    new_listing = [lst for (lst, st) in zip(listing_total, router_status) if st is status]
-                    fname = router['files'][status]
-                    use_config = [(cfg[1], cfg[2]) for cfg in configs if cfg[0] == fname]
-
-                    if len(use_config) == 0:
-                        continue
-                    proc_count += proc_loop(listing=new_listing,
-                                            base_dict=use_config[0][0],
-                                            dry_run=dry_run,
-                                            delete=delete,
-                                            remote_options=use_config[0][1])
-            else:
-                proc_count = proc_loop(listing=listing_total,
-                                       base_dict=configs[0][1],
-                                       dry_run=dry_run,
-                                       delete=delete,
-                                       remote_options=configs[0][2])
+            # one pass over each source tree, each json file becomes a key with any associated files,
+            # and if any sub directories have json files, let 'er rip
+
+            # only session directories that changed, or that we're not finished with, get listed again
+
+            start_time = time.time()
+            with tracing.span('scan', sources=len(sources)):
+                scans = [scan_source(source,
+                                     previous=previous,
+                                     rescan=None if previous is None else set(previous['members'].keys()) - settled)
+                         for source, previous in zip(sources, scans)]
+                scan = merge_scans(scans)
+            metrics.observe('dassort_scan_seconds', time.time() - start_time)
+
+            listing_total = scan['dirs'] + scan['json']
+            prune_json_index(scan['json'] + [js for jsons in scan['dirs_json'] for js in jsons])
+
+            # anything that changed needs another look, and anything that went away can be forgotten
+            settled -= scan['changed'] | scan['removed']
+            for proc in scan['removed']:
+                stability.pop(proc, None)
+
+            # anything in flight is already done by now, so it's safe to swap configs, sessions
+            # may go somewhere else now so they get another look too
+            for i, (source_config, source_scan) in enumerate(zip(source_configs, scans)):
+                source_configs[i] = reload_source(source_config, source_scan, destination, remote_defaults,
+                                                  workers=workers)
+                if source_configs[i] is not source_config:
+                    settled -= set(source_scan['members'].keys())
+
+            active = set(listing_total) - settled
+            logging.info('Scanned %d sessions, %d changed, %d to look at' %
+                         (len(listing_total), len(scan['changed']), len(active)))
+
+            routes = []
+            weights = {}
+            with tracing.span('routing', sessions=len(active)):
+                for source_config, source_scan in zip(source_configs, scans):
+                    routes += source_routes(source_config, source_scan, active=active, settled=settled)
+                    weights.update(source_config['weights'])
+
+            # everything that's ready, from every source and route, goes through one scheduler and worker pool
+            proc_count = proc_routes(routes,
+                                     dry_run=settings['dry_run'],
+                                     delete=settings['delete'],
+                                     tracker=stability,
+                                     settle_time=settle_time,
+                                     jobs=settings['jobs'],
+                                     host_jobs=settings['host_jobs'],
+                                     journal=journal,
+                                     scan=scan,
+                                     policy=settings['schedule'],
+                                     weights=weights,
+                                     settled=settled,
+                                     retries=retries,
+                                     retry_wait=settings['retry_wait'],
+                                     max_retry_wait=settings['max_retry_wait'],
+                                     max_attempts=settings['max_attempts'])
+
+            save_hash_cache(keep=scan['stat'].keys())
+            prune_present(scan['stat'].keys())
 
             if proc_count == 0:
                 sleep_time *= 2
@@ -130,16 +366,199 @@ def dassort(source, destination, wait_time, max_time, dry_run, copy_protocol, de
             else:
                 sleep_time = deepcopy(wait_time)
 
-            logging.info('Sleeping for ' + str(sleep_time) + ' seconds')
-            time.sleep(sleep_time)
+            # don't back off past the settle window if something is waiting to settle
+            pending = any(not v['ready'] for v in stability.values())
+            if pending:
+                sleep_time = min(sleep_time, max(settle_time, wait_time))
+
+            # or past the next retry
+            retry_time = next_retry(retries)
+            if retry_time is not None:
+                sleep_time = min(sleep_time, max(retry_time - time.time(), wait_time))
+
+            report = retry_report(retries)
+            metrics.set_gauge('dassort_sessions', len([r for r in report if not r['quarantined']]), state='retrying')
+            metrics.set_gauge('dassort_sessions', len([r for r in report if r['quarantined']]), state='quarantined')
+            if settings['retry_report_file'] is not None:
+                write_retry_report(retries, settings['retry_report_file'])
+
+            metrics.set_gauge('dassort_sessions', len([v for v in stability.values() if not v['ready']]),
+                              state='pending')
+            metrics.set_gauge('dassort_sessions', len([v for v in stability.values() if v['ready']]),
+                              state='stable')
+            metrics.set_gauge('dassort_sleep_seconds', sleep_time)
+            if metrics_file is not None:
+                metrics.write_textfile(metrics_file)
+
+            tracing.add_span('cycle', cycle_start, time.time() - cycle_start, cycle=cycle_count, files=proc_count)
+            tracing.flush_trace()
+            if profile_dir is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(profile_dir, '%s-cycle-%06d.prof' %
+                                                 (multiprocessing.current_process().name, cycle_count)))
+
+            if watcher is not None:
+                # wake up on changes, rescan everything every so often just in case
+                timeout = sleep_time if pending or proc_count > 0 or retry_time is not None else settings['rescan_time']
+                logging.info('Waiting up to ' + str(timeout) + ' seconds for changes')
+                changed = wait_for_events(watcher, timeout, debounce=wait_time)
+                if changed:
+                    logging.info('Detected ' + str(len(changed)) + ' changes, rescanning')
+            else:
+                logging.info('Sleeping for ' + str(sleep_time) + ' seconds')
+                time.sleep(sleep_time)
 
         except KeyboardInterrupt:
             logging.info('Quitting...')
+            close_triggers()
+            close_transports()
+            if watcher is not None:
+                close_watcher(watcher)
+            if journal is not None:
+                close_journal(journal)
+            tracing.stop_tracing()
             break
         except Exception as error:
             logging.error(error)
             raise
 
 
+@click.command()
+@click.option('--source', '-s', type=click.Path(exists=True), envvar='DASSORT_SOURCE', multiple=True,
+              default=[os.getcwd()], help='Source directory to watch (repeat for more than one)')
+@click.option('--destination', '-d', type=str, envvar='DASSORT_DESTINATION', default=os.path.join(os.getcwd(), 'tmp'))
+@click.option('--wait-time', '-w', type=click.IntRange(2, None), default=2)
+@click.option('--max-time', '-m', type=float, default=600)
+@click.option('--dry-run', type=bool, is_flag=True)
+@click.option('--copy-protocol', '-p', type=str, default='scp')
+@click.option('--delete', type=bool, is_flag=True)
+@click.option('--remote-host', '-r', type=str, envvar='DASSORT_HOST', default='transfer.rc.hms.harvard.edu')
+@click.option('--cmd-host', '-c', type=str, envvar='DASSORT_CMDHOST', default='o2.hms.harvard.edu')
+@click.option('--remote-user', '-u', type=str, envvar='DASSORT_USER', default='johanedoe')
+@click.option('--settle-time', type=float, default=30, help='Seconds a session must stay unchanged before copying')
+@click.option('--watch-mode', type=click.Choice(['poll', 'inotify']), default='poll')
+@click.option('--rescan-time', type=float, default=300, help='Full rescan interval in inotify mode')
+@click.option('--jobs', '-j', type=click.IntRange(1, None), default=1, help='Number of concurrent transfers')
+@click.option('--host-jobs', type=click.IntRange(1, None), default=None, help='Maximum concurrent transfers per host')
+@click.option('--journal', 'journal_file', type=click.Path(), default=None, help='SQLite journal for crash-safe resume')
+@click.option('--metrics-file', type=click.Path(), default=None, help='Prometheus textfile to rewrite every cycle')
+@click.option('--metrics-port', type=int, default=None, help='Serve Prometheus metrics over http on this port')
+@click.option('--schedule', type=click.Choice(['listing', 'smallest', 'oldest']), default='listing',
+              help='Order to send sessions in')
+@click.option('--bwlimit', type=float, default=None, help='Bandwidth cap per destination host (KiB/s)')
+@click.option('--hash-algorithm', type=click.Choice(['md5', 'sha1', 'sha256', 'blake2b', 'xxhash']), default='md5')
+@click.option('--hash-cache', type=click.Path(), default=None, help='File to keep computed hashes in')
+@click.option('--hash-jobs', type=click.IntRange(1, None), default=2, help='Number of threads for hashing')
+@click.option('--trigger-jobs', type=click.IntRange(1, None), default=4, help='Maximum command triggers running at once')
+@click.option('--trigger-timeout', type=float, default=None, help='Seconds before a command trigger is killed')
+@click.option('--trigger-retries', type=click.IntRange(0, None), default=2, help='Times to retry a failed command trigger')
+@click.option('--workers', type=click.IntRange(1, None), default=1,
+              help='Split the sources between this many worker processes')
+@click.option('--trace', 'trace_file', type=click.Path(), default=None,
+              help='Write Chrome trace events (chrome://tracing, Perfetto) for every stage to this file')
+@click.option('--profile-dir', type=click.Path(), default=None, help='Dump a cProfile for every cycle in here')
+@click.option('--retry-wait', type=float, default=30, help='Seconds a failed session waits, doubles every failure')
+@click.option('--max-retry-wait', type=float, default=3600, help='Longest a failed session waits between attempts')
+@click.option('--max-attempts', type=click.IntRange(0, None), default=5,
+              help='Failures in a row before a session is quarantined (0 to keep trying)')
+@click.option('--retry-report', 'retry_report_file', type=click.Path(), default=None,
+              help='Json file listing failing and quarantined sessions, rewritten every cycle')
+def dassort(source, destination, wait_time, max_time, dry_run, copy_protocol, delete, remote_host, cmd_host, remote_user,
+            settle_time, watch_mode, rescan_time, jobs, host_jobs, journal_file, metrics_file, metrics_port,
+            schedule, bwlimit, hash_algorithm, hash_cache, hash_jobs, trigger_jobs, trigger_timeout, trigger_retries,
+            workers, trace_file, profile_dir, retry_wait, max_retry_wait, max_attempts, retry_report_file):
+    """Watch one or more source directories and send sessions on their way
+
+    """
+
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
+                        format="[%(asctime)s]: %(message)s" if workers == 1 else
+                        "[%(asctime)s] %(processName)s: %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+
+    sources = [os.path.abspath(_) for _ in source]
+    workers = min(workers, len(sources))
+
+    # with more than one worker, each one gets an even share of the per-host slots (at least one), the
+    # bandwidth caps get split the same way once the yaml files are read (see load_source)
+    if host_jobs is not None:
+        host_jobs = max(host_jobs // workers, 1)
+
+    remote_defaults = {
+        'user': remote_user,
+        'host': remote_host,
+        'cmd_host': cmd_host,
+        'copy_protocol': copy_protocol,
+        'multiplex': True,
+        'control_persist': 600,
+        'control_dir': None,
+        'checksum': True,
+        'bwlimit': bwlimit,
+        'hash': hash_algorithm
+    }
+
+    settings = {
+        'destination': destination,
+        'remote_defaults': remote_defaults,
+        'wait_time': float(wait_time),
+        'max_time': max_time,
+        'dry_run': dry_run,
+        'delete': delete,
+        'settle_time': settle_time,
+        'watch_mode': watch_mode,
+        'rescan_time': rescan_time,
+        'jobs': jobs,
+        'host_jobs': host_jobs,
+        'workers': workers,
+        'journal_file': journal_file,
+        'metrics_file': metrics_file,
+        'metrics_port': metrics_port,
+        'schedule': schedule,
+        'hash_cache': hash_cache,
+        'hash_jobs': hash_jobs,
+        'trigger_jobs': trigger_jobs,
+        'trigger_timeout': trigger_timeout,
+        'trigger_retries': trigger_retries,
+        'trace_file': trace_file,
+        'profile_dir': profile_dir,
+        'retry_wait': retry_wait,
+        'max_retry_wait': max_retry_wait,
+        'max_attempts': max_attempts,
+        'retry_report_file': retry_report_file
+    }
+
+    if workers == 1:
+        watch_sources(sources, settings)
+        return
+
+    # make sure every source has a config before we fork
+    for use_source in sources:
+        load_source(use_source, destination, remote_defaults)
+
+    # big deployments can split the sources between processes, each runs its own loop (the journal
+    # is shared, everything else gets a file or port of its own)
+    processes = []
+    for worker in range(workers):
+        worker_settings = dict(settings)
+        worker_settings['metrics_file'] = worker_file(metrics_file, worker)
+        worker_settings['hash_cache'] = worker_file(hash_cache, worker)
+        worker_settings['trace_file'] = worker_file(trace_file, worker)
+        worker_settings['retry_report_file'] = worker_file(retry_report_file, worker)
+        if metrics_port is not None:
+            worker_settings['metrics_port'] = metrics_port + worker
+        process = multiprocessing.Process(target=watch_sources,
+                                          args=(sources[worker::workers], worker_settings),
+                                          name='worker-' + str(worker))
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        try:
+            process.join()
+        except KeyboardInterrupt:
+            # the workers get the interrupt too, wait for them to clean up
+            process.join()
+
+
 if __name__ == "__main__":
     dassort()
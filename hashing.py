@@ -0,0 +1,200 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# what to run on the other end to get the same digest
+REMOTE_COMMANDS = {
+    'md5': 'md5sum',
+    'sha1': 'sha1sum',
+    'sha256': 'sha256sum',
+    'blake2b': 'b2sum',
+    'xxhash': 'xxhsum'
+}
+
+# path -> {'size', 'mtime', 'inode', 'algorithm', 'digest'}
+_cache = {}
+_cache_file = None
+_cache_dirty = False
+_cache_lock = threading.Lock()
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_jobs = 2
+
+
+def resolve_algorithm(algorithm):
+    """xxhash needs the xxhash package installed, otherwise we fall back to blake2b"""
+    if algorithm is None:
+        return 'md5'
+    if algorithm == 'xxhash' and xxhash is None:
+        return 'blake2b'
+    if algorithm not in REMOTE_COMMANDS:
+        raise ValueError('Unknown hash algorithm ' + str(algorithm))
+    return algorithm
+
+
+def new_hasher(algorithm='md5'):
+    """Gets a hash object for an algorithm"""
+    algorithm = resolve_algorithm(algorithm)
+    if algorithm == 'xxhash':
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+
+def remote_command(algorithm='md5'):
+    """Command to run on the other end to get the same digest"""
+    return REMOTE_COMMANDS[resolve_algorithm(algorithm)]
+
+
+def _stat_key(file):
+    stat = os.stat(file)
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def cached_digest(file, algorithm='md5'):
+    """Looks up a file's digest in the hash cache, if it hasn't changed since
+
+    Args:
+        file: file to look up
+        algorithm: hash algorithm
+    Returns:
+        digest: hex digest, None if we don't have it
+    """
+    algorithm = resolve_algorithm(algorithm)
+    with _cache_lock:
+        entry = _cache.get(file)
+    if entry is None or entry['algorithm'] != algorithm:
+        return None
+    try:
+        size, mtime, inode = _stat_key(file)
+    except OSError:
+        return None
+    if (size, mtime, inode) != (entry['size'], entry['mtime'], entry['inode']):
+        return None
+    return entry['digest']
+
+
+def store_digest(file, algorithm, digest):
+    """Puts a file's digest in the hash cache"""
+    global _cache_dirty
+    algorithm = resolve_algorithm(algorithm)
+    try:
+        size, mtime, inode = _stat_key(file)
+    except OSError:
+        return
+    with _cache_lock:
+        _cache[file] = {
+            'size': size,
+            'mtime': mtime,
+            'inode': inode,
+            'algorithm': algorithm,
+            'digest': digest
+        }
+        _cache_dirty = True
+
+
+def hash_file(file, algorithm='md5', block_size=2**20, use_cache=True):
+    """Hashes a file, unchanged files (same size, mtime and inode) come out of the cache
+
+    Args:
+        file: file to hash
+        algorithm: hash algorithm
+        block_size: read size
+        use_cache: check and update the hash cache
+    Returns:
+        digest: hex digest
+    """
+    algorithm = resolve_algorithm(algorithm)
+
+    if use_cache:
+        digest = cached_digest(file, algorithm)
+        if digest is not None:
+            return digest
+
+    hasher = new_hasher(algorithm)
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(file, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+    digest = hasher.hexdigest()
+
+    if use_cache:
+        store_digest(file, algorithm, digest)
+
+    return digest
+
+
+def set_hash_jobs(jobs):
+    """Sets the number of threads hashing in the background"""
+    global _pool_jobs
+    _pool_jobs = max(jobs, 1)
+
+
+def hash_async(file, algorithm='md5', use_cache=True):
+    """Hashes a file in the background thread pool
+
+    Returns:
+        future: future with the hex digest
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=_pool_jobs)
+    return _pool.submit(hash_file, file, algorithm, use_cache=use_cache)
+
+
+def load_hash_cache(file):
+    """Loads the hash cache from its sidecar file, and uses that file from here on out
+
+    Args:
+        file: json file to keep the cache in
+    """
+    global _cache_file
+    _cache_file = file
+    if not os.path.exists(file):
+        return
+    try:
+        with open(file, 'r') as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as error:
+        logging.info('Could not read hash cache ' + file + ': ' + str(error))
+        return
+    with _cache_lock:
+        _cache.update(entries)
+    logging.info('Loaded ' + str(len(entries)) + ' hashes from ' + file)
+
+
+def save_hash_cache(keep=None):
+    """Writes the hash cache out (atomically) if anything changed
+
+    Args:
+        keep: if given, forget about any file that isn't in here first
+    """
+    global _cache_dirty
+    with _cache_lock:
+        if keep is not None:
+            keep = set(keep)
+            for file in [f for f in _cache if f not in keep]:
+                del _cache[file]
+                _cache_dirty = True
+        if _cache_file is None or not _cache_dirty:
+            return
+        entries = dict(_cache)
+        _cache_dirty = False
+
+    tmp_file = _cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(entries, f)
+    os.replace(tmp_file, _cache_file)
@@ -0,0 +1,132 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# manifest status goes pending -> copying -> verified -> triggered, files stop at verified
+# (remote copies sit at copied until the batched checksum on the other end matches)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifests (
+    proc TEXT PRIMARY KEY,
+    json_file TEXT,
+    destination TEXT,
+    status TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    proc TEXT,
+    size INTEGER,
+    mtime REAL,
+    hash TEXT,
+    destination TEXT,
+    status TEXT,
+    updated REAL
+);
+"""
+
+
+def open_journal(file):
+    """Opens (or creates) the transfer journal, anything that was in flight when we
+    last went down is marked pending again
+
+    Args:
+        file: sqlite database to use
+    Returns:
+        journal: dictionary with the connection and a lock to share it between workers
+    """
+    conn = sqlite3.connect(file, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+
+    journal = {
+        'conn': conn,
+        'lock': threading.Lock(),
+        'file': file
+    }
+
+    with journal['lock']:
+        files = conn.execute("UPDATE files SET status = 'pending' WHERE status = 'copying'").rowcount
+        manifests = conn.execute("UPDATE manifests SET status = 'pending' WHERE status = 'copying'").rowcount
+
+    if files > 0 or manifests > 0:
+        logging.info('Resuming %d manifests and %d files from journal %s' % (manifests, files, file))
+
+    return journal
+
+
+def close_journal(journal):
+    with journal['lock']:
+        journal['conn'].close()
+
+
+def get_manifest_status(journal, proc):
+    """Gets the status of a manifest in the journal
+
+    Args:
+        journal: journal from open_journal
+        proc: file or directory the manifest belongs to
+    Returns:
+        status: status string, None if we've never seen it
+        destination: where it was sent
+    """
+    with journal['lock']:
+        row = journal['conn'].execute('SELECT status, destination FROM manifests WHERE proc = ?',
+                                      (proc,)).fetchone()
+    if row is None:
+        return None, None
+    return row
+
+
+def set_manifest_status(journal, proc, json_file, destination, status):
+    with journal['lock']:
+        journal['conn'].execute('INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?, ?)',
+                                (proc, json_file, destination, status, time.time()))
+
+
+def set_file_status(journal, f, proc, destination, status, digest=None):
+    """Records where a file is at, along with the size and mtime we saw so we can tell if
+    it changed since
+
+    Args:
+        journal: journal from open_journal
+        f: file
+        proc: file or directory the manifest belongs to
+        destination: destination directory
+        status: pending, copying, copied or verified
+        digest: file hash if we have one
+    """
+    try:
+        stat = os.stat(f)
+        size, mtime = stat.st_size, stat.st_mtime
+    except OSError:
+        size, mtime = None, None
+
+    with journal['lock']:
+        journal['conn'].execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (f, proc, size, mtime, digest, destination, status, time.time()))
+
+
+def file_done(journal, f, destination):
+    """Has this file (unchanged) already been verified at this destination?
+
+    Args:
+        journal: journal from open_journal
+        f: file
+        destination: destination directory
+    Returns:
+        done: True if we can skip it
+    """
+    with journal['lock']:
+        row = journal['conn'].execute('SELECT size, mtime, destination, status FROM files WHERE path = ?',
+                                      (f,)).fetchone()
+    if row is None or row[3] != 'verified' or row[2] != destination:
+        return False
+
+    try:
+        stat = os.stat(f)
+    except OSError:
+        return False
+
+    return stat.st_size == row[0] and stat.st_mtime == row[1]
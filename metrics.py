@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# name -> (type, help)
+_meta = {}
+# name -> {labels: value} for counters and gauges, {labels: [bucket counts, sum, count]} for histograms
+_values = {}
+_lock = threading.Lock()
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 600, 1800, 3600)
+_buckets = {}
+
+
+def describe(name, metric_type, help, buckets=DEFAULT_BUCKETS):
+    """Registers a metric
+
+    Args:
+        name: metric name
+        metric_type: counter, gauge or histogram
+        help: help string
+        buckets: histogram bucket upper bounds
+    """
+    with _lock:
+        _meta[name] = (metric_type, help)
+        _values.setdefault(name, {})
+        if metric_type == 'histogram':
+            _buckets[name] = tuple(sorted(buckets))
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Increments a counter"""
+    with _lock:
+        series = _values.setdefault(name, {})
+        key = _key(labels)
+        series[key] = series.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Sets a gauge"""
+    with _lock:
+        _values.setdefault(name, {})[_key(labels)] = value
+
+
+def observe(name, value, **labels):
+    """Adds an observation to a histogram"""
+    with _lock:
+        buckets = _buckets.get(name, DEFAULT_BUCKETS)
+        series = _values.setdefault(name, {})
+        key = _key(labels)
+        if key not in series:
+            series[key] = [[0] * len(buckets), 0.0, 0]
+        entry = series[key]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                entry[0][i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+
+def _format_labels(key, extra=()):
+    labels = list(key) + list(extra)
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(['%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                           for k, v in labels]) + '}'
+
+
+def render():
+    """Renders every metric in the Prometheus text exposition format
+
+    Returns:
+        text: metrics text
+    """
+    lines = []
+    with _lock:
+        for name in sorted(_values.keys()):
+            metric_type, help = _meta.get(name, ('untyped', ''))
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for key, value in sorted(_values[name].items()):
+                if metric_type == 'histogram':
+                    buckets = _buckets.get(name, DEFAULT_BUCKETS)
+                    for bound, count in zip(buckets, value[0]):
+                        lines.append('%s_bucket%s %d' % (name, _format_labels(key, [('le', repr(float(bound)))]),
+                                                         count))
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(key, [('le', '+Inf')]), value[2]))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(key), repr(float(value[1]))))
+                    lines.append('%s_count%s %d' % (name, _format_labels(key), value[2]))
+                else:
+                    lines.append('%s%s %s' % (name, _format_labels(key), repr(float(value))))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(file):
+    """Writes the metrics out for the node exporter's textfile collector, atomically so
+    nobody ever reads half a file
+
+    Args:
+        file: file to write
+    """
+    tmp_file = file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(render())
+    os.replace(tmp_file, file)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, addr=''):
+    """Serves the metrics over http in a background thread
+
+    Args:
+        port: port to listen on
+        addr: address to bind to
+    Returns:
+        server: the http server
+    """
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info('Serving metrics on port ' + str(port))
+    return server
+
+
+describe('dassort_scan_seconds', 'histogram', 'Time spent scanning the source directory')
+describe('dassort_sessions', 'gauge', 'Sessions in the source directory by state')
+describe('dassort_sessions_total', 'counter', 'Sessions processed by outcome')
+describe('dassort_stability_wait_seconds', 'histogram', 'Time from first seeing a session to it being stable')
+describe('dassort_router_hits_total', 'counter', 'Sessions matched by each route')
+describe('dassort_bytes_total', 'counter', 'Bytes transferred')
+describe('dassort_files_total', 'counter', 'Files transferred by outcome')
+describe('dassort_transfer_seconds', 'histogram', 'Time spent transferring a file')
+describe('dassort_throughput_bytes_per_second', 'gauge', 'Throughput of the last transfer')
+describe('dassort_checksum_seconds', 'histogram', 'Time spent checksumming a file')
+describe('dassort_trigger_seconds', 'histogram', 'Time spent running a command trigger, retries included')
+describe('dassort_trigger_latency_seconds', 'histogram', 'Time from starting on a session to its trigger firing')
+describe('dassort_triggers_total', 'counter', 'Command triggers by outcome')
+describe('dassort_triggers_pending', 'gauge', 'Command triggers queued or running')
+describe('dassort_sleep_seconds', 'gauge', 'Current backoff sleep time in the main loop')
+describe('dassort_compression_bytes_total', 'counter', 'Bytes before and after compression')
+describe('dassort_compression_seconds', 'histogram', 'Time spent compressing a file')
+describe('dassort_compression_ratio', 'histogram', 'Original size over compressed size',
+         buckets=(1, 1.1, 1.25, 1.5, 2, 3, 4, 6, 8, 12, 16))
@@ -0,0 +1,200 @@
+import logging
+import os
+import time
+from bisect import bisect_left
+
+# directories that changed this recently get listed again no matter what their mtime says
+RACY_TIME = 2
+
+
+def scan_source(source, previous=None, rescan=None, now=None):
+    """Walks the source directory once with scandir, keeping the stat results around so
+    nobody else has to hit the filesystem again this cycle. Json files in the source
+    directory are manifests with every file that starts with the same name, sub-directories
+    with json files are manifests with every file in the directory.
+
+    Given the scan from the last cycle, sub-directories whose mtime hasn't changed are taken
+    from it instead of being listed again, so the cost goes with how much changed rather than
+    with how many sessions are sitting there. A directory's mtime only moves when files come
+    or go, so anything still being written to should be in rescan.
+
+    Args:
+        source: source directory
+        previous: scan of the same source from the last cycle
+        rescan: sub-directories to list again no matter what (e.g. sessions still settling)
+        now: current time, defaults to time.time()
+    Returns:
+        scan: dictionary with
+            'stat': path -> stat result for every file we saw
+            'json': json files in the source directory
+            'dirs': sub-directories with json files in them
+            'dirs_json': list of json files for each of those sub-directories
+            'members': file or directory -> files in its manifest
+            'dir_mtime': sub-directory -> mtime, for every sub-directory we saw
+            'dir_files': sub-directory -> files in it, for every sub-directory we saw
+            'signatures': file or directory -> (name, size, mtime) of everything in its manifest
+            'changed': manifests that are new or changed since the previous scan (all of them without one)
+            'removed': manifests from the previous scan that are gone
+    """
+    if now is None:
+        now = time.time()
+    if rescan is None:
+        rescan = set()
+
+    scan = {
+        'source': source,
+        'stat': {},
+        'json': [],
+        'dirs': [],
+        'dirs_json': [],
+        'members': {},
+        'dir_mtime': {},
+        'dir_files': {},
+        'signatures': {},
+        'changed': set(),
+        'removed': set()
+    }
+
+    names = []
+
+    with os.scandir(source) as it:
+        entries = sorted(it, key=lambda x: x.name)
+
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                mtime = entry.stat().st_mtime_ns
+                # racy: if the directory changed in the last couple of seconds its mtime may not
+                # move again for the next change (coarse timestamps), so list it anyway
+                if (previous is not None
+                    and previous['dir_mtime'].get(entry.path) == mtime
+                    and entry.path not in rescan
+                    and now - mtime / 1e9 > RACY_TIME):
+                    reuse_dir(scan, previous, entry.path)
+                else:
+                    scan_dir(scan, entry.path, mtime)
+            elif entry.is_file():
+                scan['stat'][entry.path] = entry.stat()
+                names.append(entry.name)
+        except OSError as error:
+            # something got moved or deleted out from under us
+            logging.info('Could not scan ' + entry.path + ': ' + str(error))
+
+    # files that match a json file's name go along with it, names are sorted so we can
+    # find everything with the same prefix with a binary search
+    others = [f for f in names if not f.endswith('.json')]
+    for f in names:
+        if not f.endswith('.json'):
+            continue
+        js = os.path.join(source, f)
+        stem = os.path.splitext(f)[0]
+        members = []
+        idx = bisect_left(others, stem)
+        while idx < len(others) and others[idx].startswith(stem):
+            members.append(os.path.join(source, others[idx]))
+            idx += 1
+        scan['json'].append(js)
+        scan['members'][js] = members + [js]
+
+    for proc, members in scan['members'].items():
+        if proc not in scan['signatures']:
+            scan['signatures'][proc] = manifest_signature(members, scan['stat'])
+        if previous is None or previous['signatures'].get(proc) != scan['signatures'][proc]:
+            scan['changed'].add(proc)
+
+    if previous is not None:
+        scan['removed'] = set(previous['members'].keys()) - set(scan['members'].keys())
+
+    return scan
+
+
+def manifest_signature(members, stats):
+    """What a manifest looks like right now, to tell if it changed between scans"""
+    return tuple(sorted([(f, stats[f].st_size, stats[f].st_mtime_ns) for f in members if f in stats]))
+
+
+def scan_dir(scan, path, mtime=None):
+    """Scans a session sub-directory and adds it to the scan if it has a json file
+
+    Args:
+        scan: scan dictionary from scan_source
+        path: sub-directory to scan
+        mtime: the sub-directory's mtime, so we can tell next time if it changed
+    """
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file():
+                scan['stat'][entry.path] = entry.stat()
+                files.append(entry.path)
+
+    scan['dir_mtime'][path] = mtime
+    scan['dir_files'][path] = files
+
+    dir_json = sorted([f for f in files if f.endswith('.json')])
+    if len(dir_json) > 0:
+        scan['dirs'].append(path)
+        scan['dirs_json'].append(dir_json)
+        scan['members'][path] = files
+
+
+def reuse_dir(scan, previous, path):
+    """Takes an unchanged sub-directory from the last scan instead of listing it again
+
+    Args:
+        scan: scan dictionary from scan_source
+        previous: scan from the last cycle
+        path: sub-directory to take
+    """
+    files = previous['dir_files'][path]
+    for f in files:
+        if f in previous['stat']:
+            scan['stat'][f] = previous['stat'][f]
+
+    scan['dir_mtime'][path] = previous['dir_mtime'][path]
+    scan['dir_files'][path] = files
+
+    if path in previous['members']:
+        scan['dirs'].append(path)
+        scan['dirs_json'].append(sorted([f for f in files if f.endswith('.json')]))
+        scan['members'][path] = files
+        scan['signatures'][path] = previous['signatures'][path]
+
+
+def merge_scans(scans):
+    """Puts the scans of several source directories together, so the rest of the cycle can
+    treat them as one
+
+    Args:
+        scans: list of scans from scan_source
+    Returns:
+        scan: one scan with everything in it ('source' is the list of source directories)
+    """
+    scan = {
+        'source': [],
+        'stat': {},
+        'json': [],
+        'dirs': [],
+        'dirs_json': [],
+        'members': {},
+        'dir_mtime': {},
+        'dir_files': {},
+        'signatures': {},
+        'changed': set(),
+        'removed': set()
+    }
+
+    for use_scan in scans:
+        scan['source'].append(use_scan['source'])
+        scan['stat'].update(use_scan['stat'])
+        scan['json'] += use_scan['json']
+        scan['dirs'] += use_scan['dirs']
+        scan['dirs_json'] += use_scan['dirs_json']
+        scan['members'].update(use_scan['members'])
+        scan['dir_mtime'].update(use_scan['dir_mtime'])
+        scan['dir_files'].update(use_scan['dir_files'])
+        scan['signatures'].update(use_scan['signatures'])
+        scan['changed'] |= use_scan['changed']
+        scan['removed'] |= use_scan['removed']
+
+    return scan
@@ -0,0 +1,230 @@
+import json
+import os
+import threading
+import time
+
+POLICIES = ('listing', 'smallest', 'oldest')
+
+# host -> time the last reserved byte goes out
+_bandwidth = {}
+_bandwidth_lock = threading.Lock()
+
+# retry state gets updated from the trigger threads too
+_retry_lock = threading.Lock()
+
+
+def order_manifests(manifests, policy='listing', weights=None):
+    """Puts the manifests from every route into one queue. Each route is sorted by the
+    policy, then routes take turns according to their weights (smooth weighted round robin),
+    so one giant session can't starve everything behind it.
+
+    Args:
+        manifests: list of dictionaries with at least 'route', 'size' and 'mtime'
+        policy: listing (leave them be), smallest (fewest bytes first) or oldest (oldest first)
+        weights: dictionary of route -> weight, routes that aren't in there get 1
+    Returns:
+        queue: the manifests in the order they should go out
+    """
+    if policy not in POLICIES:
+        raise NotImplementedError('Unknown scheduling policy ' + str(policy))
+
+    if weights is None:
+        weights = {}
+
+    routes = []
+    queues = {}
+    for manifest in manifests:
+        if manifest['route'] not in queues:
+            routes.append(manifest['route'])
+            queues[manifest['route']] = []
+        queues[manifest['route']].append(manifest)
+
+    for route in routes:
+        if policy == 'smallest':
+            queues[route].sort(key=lambda x: x['size'])
+        elif policy == 'oldest':
+            queues[route].sort(key=lambda x: x['mtime'])
+
+    # smooth weighted round robin, same idea as nginx upstreams
+    current = {route: 0 for route in routes}
+    queue = []
+    while len(queue) < len(manifests):
+        active = [route for route in routes if len(queues[route]) > 0]
+        total = 0
+        for route in active:
+            weight = weights.get(route)
+            weight = 1 if weight is None else weight
+            current[route] += weight
+            total += weight
+        route = max(active, key=lambda x: current[x])
+        current[route] -= total
+        queue.append(queues[route].pop(0))
+
+    return queue
+
+
+def throttle(host, nbytes, rate):
+    """Keeps everything going to a host under a shared bandwidth cap. Each caller reserves
+    time for its bytes and waits its turn.
+
+    Args:
+        host: destination host
+        nbytes: number of bytes about to be sent
+        rate: cap in bytes per second (None or 0 for no cap)
+    """
+    if not rate:
+        return
+
+    with _bandwidth_lock:
+        now = time.time()
+        start = max(now, _bandwidth.get(host, now))
+        _bandwidth[host] = start + nbytes / float(rate)
+
+    if start > now:
+        time.sleep(start - now)
+
+
+def budget(rate):
+    """Like throttle, but with a budget of its own rather than the host's, for a single transfer
+    (and everything it runs in parallel, like chunks)
+
+    Args:
+        rate: cap in bytes per second
+    Returns:
+        use_budget: function called with the number of bytes about to be sent
+    """
+    state = {'next': None}
+    lock = threading.Lock()
+
+    def use_budget(nbytes):
+        with lock:
+            now = time.time()
+            start = now if state['next'] is None else max(now, state['next'])
+            state['next'] = start + nbytes / float(rate)
+        if start > now:
+            time.sleep(start - now)
+
+    return use_budget
+
+
+def retry_due(retries, proc, now=None):
+    """Can a manifest go out this cycle? Not if it's backing off after a failure, or quarantined
+
+    Args:
+        retries: dictionary kept between cycles, proc -> {'attempts', 'next', 'quarantined', ...}
+        proc: file or directory the manifest belongs to
+        now: current time, defaults to time.time()
+    Returns:
+        due: True if it can go
+    """
+    if now is None:
+        now = time.time()
+    with _retry_lock:
+        entry = retries.get(proc)
+        return entry is None or (not entry['quarantined'] and now >= entry['next'])
+
+
+def record_failure(retries, proc, reason, now=None, retry_wait=30, max_retry_wait=3600, max_attempts=5,
+                   snapshot=None):
+    """Backs a manifest off after a failure, doubling the wait every time, and quarantines it once
+    it's failed max_attempts times in a row
+
+    Args:
+        retries: dictionary kept between cycles (see retry_due)
+        proc: file or directory the manifest belongs to
+        reason: what went wrong, for the report
+        now: current time, defaults to time.time()
+        retry_wait: seconds to wait after the first failure
+        max_retry_wait: longest we ever wait between attempts
+        max_attempts: failures before it's quarantined (None or 0 to keep trying forever)
+        snapshot: the manifest's snapshot (see util.snapshot_manifest), quarantine is lifted when it changes
+    Returns:
+        quarantined: True if it just got quarantined
+    """
+    if now is None:
+        now = time.time()
+    with _retry_lock:
+        entry = retries.setdefault(proc, {'attempts': 0, 'first': now, 'quarantined': False})
+        entry['attempts'] += 1
+        entry['last'] = now
+        entry['reason'] = reason
+        entry['snapshot'] = snapshot
+        entry['next'] = now + min(retry_wait * 2**(entry['attempts'] - 1), max_retry_wait)
+        entry['quarantined'] = bool(max_attempts) and entry['attempts'] >= max_attempts
+        return entry['quarantined']
+
+
+def record_success(retries, proc):
+    """Forgets about a manifest's failures"""
+    with _retry_lock:
+        retries.pop(proc, None)
+
+
+def release_changed(retries, tracker):
+    """Gives quarantined manifests another go if anything about them changed since (somebody fixed
+    them, presumably), and forgets about any that are gone
+
+    Args:
+        retries: dictionary kept between cycles (see retry_due)
+        tracker: stability tracker (see util.check_stability)
+    Returns:
+        released: list of manifests let out of quarantine
+    """
+    released = []
+    with _retry_lock:
+        for proc in list(retries.keys()):
+            entry = retries[proc]
+            if proc not in tracker:
+                del retries[proc]
+            elif entry['quarantined'] and tracker[proc]['snapshot'] != entry['snapshot']:
+                del retries[proc]
+                released.append(proc)
+    return released
+
+
+def quarantined(retries):
+    """Manifests that are quarantined"""
+    with _retry_lock:
+        return [proc for proc, entry in retries.items() if entry['quarantined']]
+
+
+def next_retry(retries):
+    """Time the next manifest backing off can go again, None if there aren't any"""
+    with _retry_lock:
+        times = [entry['next'] for entry in retries.values() if not entry['quarantined']]
+    return min(times) if len(times) > 0 else None
+
+
+def retry_report(retries):
+    """Everything that's failing, quarantined manifests first
+
+    Args:
+        retries: dictionary kept between cycles (see retry_due)
+    Returns:
+        report: list of dictionaries with the manifest, attempts, first and last failure, the last reason,
+                when it goes again and whether it's quarantined
+    """
+    with _retry_lock:
+        report = [{
+            'proc': proc,
+            'attempts': entry['attempts'],
+            'first_failure': entry['first'],
+            'last_failure': entry['last'],
+            'reason': entry['reason'],
+            'next_attempt': None if entry['quarantined'] else entry['next'],
+            'quarantined': entry['quarantined']
+        } for proc, entry in retries.items()]
+    return sorted(report, key=lambda x: (not x['quarantined'], x['proc']))
+
+
+def write_retry_report(retries, file):
+    """Writes the retry report (see retry_report) out as json, atomically like the metrics textfile
+
+    Args:
+        retries: dictionary kept between cycles (see retry_due)
+        file: file to write
+    """
+    tmp_file = file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(retry_report(retries), f, indent=2)
+    os.replace(tmp_file, file)
@@ -0,0 +1,82 @@
+"""A session whose copy keeps failing backs off and ends up quarantined, even with a command trigger
+on it
+
+    python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import read_config, proc_routes  # noqa: E402
+from journal import open_journal, close_journal  # noqa: E402
+from triggers import close_triggers  # noqa: E402
+
+
+@pytest.fixture
+def session(tmp_path):
+    """Source directory with one session sub-directory, a local destination where depth.dat can't be
+    written, and a trigger on depth.dat that leaves a marker behind if it ever runs
+
+    Returns:
+        session: dictionary with the 'proc', the 'marker' the trigger writes, the 'routes' to send
+                 it with and a 'journal'
+    """
+    source = tmp_path / 'source'
+    proc = source / 'session1'
+    proc.mkdir(parents=True)
+    destination = tmp_path / 'destination'
+
+    (proc / 'depth.dat').write_bytes(os.urandom(1000))
+    (proc / 'metadata.json').write_text(json.dumps({'SubjectName': 'mouse1'}))
+
+    # a directory in the way, so the copy fails every time
+    (destination / 'mouse1' / 'session1' / 'depth.dat').mkdir(parents=True)
+
+    marker = tmp_path / 'triggered'
+    config = source / 'dassort.yaml'
+    config.write_text('dassort:\n'
+                      '  json:\n'
+                      '    keys: [SubjectName]\n'
+                      '    map: [subject]\n'
+                      '    default: [unsorted]\n'
+                      '  path: ${root}/${subject}/${sub_folder}\n'
+                      '  command:\n'
+                      '    exts: [depth.dat]\n'
+                      '    run: [\'touch ' + str(marker) + '\']\n'
+                      'remote:\n'
+                      '  copy_protocol: cp\n')
+
+    base_dict, remote_options, _ = read_config(str(config), str(destination))
+    journal = open_journal(str(tmp_path / 'journal.db'))
+
+    yield {
+        'proc': str(proc),
+        'marker': str(marker),
+        'routes': [{
+            'name': None,
+            'listing': [str(proc)],
+            'base_dict': base_dict,
+            'remote_options': remote_options
+        }],
+        'journal': journal
+    }
+
+    close_journal(journal)
+
+
+def test_quarantine_with_trigger(session):
+    retries = {}
+    tracker = {}
+    # the first cycle only takes the snapshot
+    for _ in range(3):
+        assert proc_routes(session['routes'], dry_run=False, delete=False, tracker=tracker, settle_time=0,
+                           journal=session['journal'], retries=retries, retry_wait=0, max_attempts=2) == 0
+    close_triggers()
+
+    assert not os.path.exists(session['marker'])
+    assert retries[session['proc']]['attempts'] == 2
+    assert retries[session['proc']]['quarantined']
@@ -0,0 +1,169 @@
+"""Runs a manifest through the rsync backend into a local directory (host: localhost), including
+resuming a partial transfer and skipping files the journal already has. Those are skipped if rsync
+isn't installed, unless DASSORT_REQUIRE_RSYNC is set (then they fail), and the command we'd hand
+rsync for a remote host gets checked either way
+
+    python -m pytest tests
+"""
+import filecmp
+import json
+import os
+import shlex
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import read_config, proc_loop  # noqa: E402
+from journal import open_journal, close_journal, get_manifest_status, set_file_status  # noqa: E402
+from transport import batch_command  # noqa: E402
+
+needs_rsync = pytest.mark.skipif(shutil.which('rsync') is None and not os.environ.get('DASSORT_REQUIRE_RSYNC'),
+                                 reason='rsync not installed')
+
+
+@pytest.fixture
+def session(tmp_path):
+    """Source directory with one session sub-directory, and a config sending it with rsync to a local
+    destination
+
+    Returns:
+        session: dictionary with the 'proc', its 'files', where they should end up ('new_path'),
+                 and the 'base_dict' and 'remote_options' to send it with
+    """
+    source = tmp_path / 'source'
+    proc = source / 'session1'
+    proc.mkdir(parents=True)
+    destination = tmp_path / 'destination'
+    destination.mkdir()
+
+    (proc / 'depth.dat').write_bytes(os.urandom(3 * 2**20))
+    (proc / 'ts.txt').write_bytes(os.urandom(1000))
+    (proc / 'metadata.json').write_text(json.dumps({'SubjectName': 'mouse1'}))
+
+    config = source / 'dassort.yaml'
+    config.write_text('dassort:\n'
+                      '  json:\n'
+                      '    keys: [SubjectName]\n'
+                      '    map: [subject]\n'
+                      '    default: [unsorted]\n'
+                      '  path: ${root}/${subject}/${sub_folder}\n'
+                      'remote:\n'
+                      '  copy_protocol: rsync\n'
+                      '  host: localhost\n')
+
+    base_dict, remote_options, _ = read_config(str(config), str(destination))
+
+    return {
+        'proc': str(proc),
+        'files': sorted(os.listdir(str(proc))),
+        'new_path': os.path.join(str(destination), 'mouse1', 'session1', ''),
+        'base_dict': base_dict,
+        'remote_options': remote_options
+    }
+
+
+def send(session, journal=None):
+    return proc_loop(listing=[session['proc']],
+                     base_dict=session['base_dict'],
+                     dry_run=False,
+                     delete=False,
+                     remote_options=session['remote_options'],
+                     settle_time=0,
+                     journal=journal)
+
+
+def assert_copied(session):
+    assert sorted(os.listdir(session['new_path'])) == session['files']
+    for f in session['files']:
+        assert filecmp.cmp(os.path.join(session['proc'], f), os.path.join(session['new_path'], f), shallow=False)
+
+
+@needs_rsync
+def test_send(session):
+    assert send(session) == len(session['files'])
+    assert_copied(session)
+
+
+@needs_rsync
+def test_resume_partial(session):
+    # what rsync leaves behind when it's cut off halfway through a file
+    partial_dir = os.path.join(session['new_path'], '.dassort-partial')
+    os.makedirs(partial_dir)
+    with open(os.path.join(session['proc'], 'depth.dat'), 'rb') as f:
+        data = f.read()
+    with open(os.path.join(partial_dir, 'depth.dat'), 'wb') as f:
+        f.write(data[:len(data) // 2])
+
+    assert send(session) == len(session['files'])
+    assert_copied(session)
+
+
+@needs_rsync
+def test_skip_journal(session, tmp_path):
+    journal = open_journal(str(tmp_path / 'journal.db'))
+    try:
+        assert send(session, journal) == len(session['files'])
+        assert get_manifest_status(journal, session['proc']) == ('verified', session['new_path'])
+
+        # nothing left to do the second time around
+        mtimes = {f: os.stat(os.path.join(session['new_path'], f)).st_mtime_ns for f in session['files']}
+        assert send(session, journal) == 0
+        assert {f: os.stat(os.path.join(session['new_path'], f)).st_mtime_ns for f in session['files']} == mtimes
+
+        # a file that changed goes again
+        with open(os.path.join(session['proc'], 'ts.txt'), 'ab') as f:
+            f.write(b'more')
+        assert send(session, journal) == 1
+        assert_copied(session)
+    finally:
+        close_journal(journal)
+
+
+@needs_rsync
+def test_resume_journal(session, tmp_path):
+    journal_file = str(tmp_path / 'journal.db')
+    journal = open_journal(journal_file)
+    assert send(session, journal) == len(session['files'])
+
+    # went down in the middle of sending depth.dat, which never made it
+    os.remove(os.path.join(session['new_path'], 'depth.dat'))
+    set_file_status(journal, os.path.join(session['proc'], 'depth.dat'), session['proc'], session['new_path'],
+                    'copying')
+    close_journal(journal)
+
+    journal = open_journal(journal_file)
+    try:
+        assert send(session, journal) == 1
+        assert_copied(session)
+    finally:
+        close_journal(journal)
+
+
+def test_remote_command(tmp_path):
+    remote_options = {
+        'copy_protocol': 'rsync',
+        'user': 'user',
+        'host': 'transfer',
+        'multiplex': True,
+        'control_persist': 600,
+        'control_dir': str(tmp_path / 'ssh dir'),
+        'bwlimit': 1000,
+        'bwlimit_slots': 2
+    }
+    files = [str(tmp_path / 'session 1' / 'depth.dat'), str(tmp_path / 'session 1' / 'ts.txt')]
+
+    # what the shell hands rsync
+    args = shlex.split(batch_command(files, '/data/mouse 1/session 1/', remote_options))
+    assert args[0] == 'rsync'
+    assert '--partial-dir=.dassort-partial' in args
+    assert '--protect-args' in args
+    assert args[args.index('--bwlimit') + 1] == '500'
+    assert args[-3:] == files + ['user@transfer:/data/mouse 1/session 1/']
+
+    # rsync splits -e itself, quotes keep the control path in one piece
+    ssh = shlex.split(args[args.index('-e') + 1])
+    assert ssh[0] == 'ssh'
+    assert 'ControlPath=' + os.path.join(str(tmp_path / 'ssh dir'), '%C') in ssh
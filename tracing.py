@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# events go straight out in the Chrome trace-event (JSON array) format, the closing bracket is
+# optional there, so a daemon that gets killed still leaves a file chrome://tracing and Perfetto can load
+_file = None
+_lock = threading.Lock()
+_first = True
+_threads = set()
+
+# session, route, protocol... that every span started on this thread gets tagged with
+_local = threading.local()
+
+
+def start_tracing(file):
+    """Starts writing trace events to a file (overwriting it)
+
+    Args:
+        file: json file to write
+    """
+    global _file, _first
+    with _lock:
+        _file = open(file, 'w')
+        _file.write('[')
+        _first = True
+        _threads.clear()
+    _write({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 0,
+            'args': {'name': 'dassort (' + str(os.getpid()) + ')'}})
+    logging.info('Writing trace events to ' + file)
+
+
+def _write(event):
+    global _first
+    with _lock:
+        if _file is None:
+            return
+        _file.write(('\n' if _first else ',\n') + json.dumps(event, default=str))
+        _first = False
+
+
+def current_tags():
+    """Tags set on this thread (see tags), to hand on to other threads"""
+    return dict(getattr(_local, 'tags', {}))
+
+
+@contextmanager
+def tags(**kwargs):
+    """Tags every span started on this thread inside the block
+
+    Args:
+        **kwargs: tags to add, e.g. session, route and protocol
+    """
+    old = getattr(_local, 'tags', {})
+    _local.tags = dict(old, **kwargs)
+    try:
+        yield
+    finally:
+        _local.tags = old
+
+
+def add_span(name, start, duration, cat='dassort', **kwargs):
+    """Writes a complete span, for things we only know about after the fact
+
+    Args:
+        name: span name
+        start: time it started (seconds since the epoch)
+        duration: how long it took (seconds)
+        cat: category
+        **kwargs: extra tags, on top of the ones for this thread
+    """
+    if _file is None:
+        return
+    tid = threading.get_ident()
+    if tid not in _threads:
+        _threads.add(tid)
+        _write({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                'args': {'name': threading.current_thread().name}})
+    _write({
+        'name': name,
+        'cat': cat,
+        'ph': 'X',
+        'ts': start * 1e6,
+        'dur': max(duration, 0) * 1e6,
+        'pid': os.getpid(),
+        'tid': tid,
+        'args': dict(getattr(_local, 'tags', {}), **kwargs)
+    })
+
+
+@contextmanager
+def span(name, cat='dassort', **kwargs):
+    """Times the block as a span, does nothing unless we're tracing
+
+    Args:
+        name: span name
+        cat: category
+        **kwargs: extra tags, on top of the ones for this thread
+    """
+    if _file is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_span(name, start, time.time() - start, cat=cat, **kwargs)
+
+
+def flush_trace():
+    """Makes sure everything so far is on disk"""
+    with _lock:
+        if _file is not None:
+            _file.flush()
+
+
+def stop_tracing():
+    """Finishes off the trace file"""
+    global _file
+    with _lock:
+        if _file is None:
+            return
+        _file.write('\n]\n')
+        _file.close()
+        _file = None
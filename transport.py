@@ -0,0 +1,424 @@
+import errno
+import logging
+import os
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from hashing import new_hasher
+from scheduler import throttle
+
+# hosts we've opened a master connection to, so we can close them on the way out
+_masters = set()
+_masters_lock = threading.Lock()
+
+
+def ssh_options(remote_options):
+    """Options to share one multiplexed SSH connection per user and host across every
+    mkdir, scp and ssh we issue
+
+    Args:
+        remote_options: remote configuration from read_config
+    Returns:
+        options: string of ssh options
+    """
+    if not remote_options.get('multiplex'):
+        return ''
+
+    control_dir = remote_options.get('control_dir')
+    if control_dir is None:
+        control_dir = os.path.join(tempfile.gettempdir(), 'dassort-ssh-' + str(os.getuid()))
+    os.makedirs(control_dir, mode=0o700, exist_ok=True)
+
+    with _masters_lock:
+        _masters.add((remote_options['user'], remote_options['host'], control_dir))
+
+    # %C is a hash of the connection, keeps us under the unix socket path limit
+    return ("-o ControlMaster=auto -o ControlPath=\"%s\" -o ControlPersist=%s" %
+            (os.path.join(control_dir, '%C'), str(remote_options.get('control_persist', 600))))
+
+
+def rsync_remote(remote_options):
+    """Is rsync going to another host, or just another local directory?"""
+    return remote_options.get('host') not in (None, '', 'localhost')
+
+
+def bwlimit_share(remote_options):
+    """Each transfer's share of the host's bandwidth cap (KiB/s), None if there's no cap"""
+    if not remote_options.get('bwlimit'):
+        return None
+    return float(remote_options['bwlimit']) / max(remote_options.get('bwlimit_slots', 1), 1)
+
+
+def bwlimit_option(remote_options, flag, scale):
+    """Command line option to cap a transfer at its share of the host's bandwidth
+
+    Args:
+        remote_options: remote configuration from read_config
+        flag: option flag (-l for scp, --bwlimit for rsync)
+        scale: multiplier to get from KiB/s to the units the command wants
+    Returns:
+        option: option string with a leading space, or an empty string if there's no cap
+    """
+    share = bwlimit_share(remote_options)
+    if share is None:
+        return ''
+    return ' %s %d' % (flag, max(int(share * scale), 1))
+
+
+def dir_command(new_path, remote_options):
+    """Command to create the destination directory
+
+    Args:
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+    Returns:
+        dir_cmd: command string
+    """
+    if is_remote(remote_options):
+        return "ssh %s %s@%s 'mkdir -p \"%s\"'" % (
+            ssh_options(remote_options), remote_options['user'], remote_options['host'], new_path)
+    elif remote_options['copy_protocol'] in ('nocopy', 'fake'):
+        return ''
+    elif remote_options['copy_protocol'] in ('cp', 'rsync'):
+        return "mkdir -p \"%s\"" % (new_path)
+    else:
+        raise NotImplementedError
+
+
+def copy_command(f, new_path, remote_options):
+    """Command to copy a file to the destination directory
+
+    Args:
+        f: file to copy
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+    Returns:
+        cp_cmd: command string
+    """
+    if remote_options['copy_protocol'] == 'scp':
+        return "scp %s%s \"%s\" %s@%s:'\"%s\"'" % (
+            ssh_options(remote_options), bwlimit_option(remote_options, '-l', 8.192), f, remote_options['user'], remote_options['host'], new_path)
+    elif remote_options['copy_protocol'] in ('nocopy', 'fake'):
+        return ''
+    elif remote_options['copy_protocol'] == 'cp':
+        return "cp \"%s\" \"%s\"" % (f, new_path)
+    elif remote_options['copy_protocol'] == 'rsync':
+        return batch_command([f], new_path, remote_options)
+    else:
+        raise NotImplementedError
+
+
+def batch_command(files, new_path, remote_options):
+    """Command to send a whole batch of files to the destination directory in one go.
+    Partial transfers are kept around in a partial dir so the next attempt picks up where
+    we left off, and files that already match (size and checksum) are skipped.
+
+    Args:
+        files: files to copy
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+    Returns:
+        cp_cmd: command string
+    """
+    if remote_options['copy_protocol'] != 'rsync':
+        raise NotImplementedError
+
+    file_list = ' '.join(['"%s"' % f for f in files])
+    rsync_cmd = "rsync --archive --checksum --partial-dir=.dassort-partial --protect-args" + \
+        bwlimit_option(remote_options, '--bwlimit', 1)
+
+    # rsync does its own compression on the wire, and knows to skip most compressed formats
+    if remote_options.get('compression') and rsync_remote(remote_options):
+        rsync_cmd += " --compress"
+
+    if rsync_remote(remote_options):
+        return "%s -e \"ssh %s\" %s \"%s@%s:%s/\"" % (
+            rsync_cmd, ssh_options(remote_options).replace('"', '\\"'), file_list,
+            remote_options['user'], remote_options['host'], new_path.rstrip('/'))
+    else:
+        return "%s %s \"%s/\"" % (rsync_cmd, file_list, new_path.rstrip('/'))
+
+
+def verify_command(files, new_path, remote_options, hash_cmd='md5sum', stored=None):
+    """Command to checksum a whole batch of files on the remote end in one go
+
+    Args:
+        files: file names (relative to new_path) to check
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+        hash_cmd: checksum command to run (see hashing.remote_command)
+        stored: dictionary of file name -> (stored name, decompress command) for files that are
+                stored compressed, these get checked after unpacking them
+    Returns:
+        verify_cmd: command string
+    """
+    if not is_remote(remote_options):
+        raise NotImplementedError
+
+    if stored is None:
+        stored = {}
+
+    cmds = []
+    plain = [f for f in files if f not in stored]
+    if len(plain) > 0:
+        cmds.append('%s -- %s' % (hash_cmd, ' '.join(['"%s"' % f for f in plain])))
+    for f in [f for f in files if f in stored]:
+        # same "digest  name" line as the rest
+        cmds.append('echo "$(%s \"%s\" | %s | cut -d \" \" -f 1)  %s"' % (stored[f][1], stored[f][0], hash_cmd, f))
+
+    return "ssh %s %s@%s 'cd \"%s\" && { %s; }'" % (
+        ssh_options(remote_options), remote_options['user'], remote_options['host'], new_path, '; '.join(cmds))
+
+
+def bundle_command(new_path, remote_options):
+    """Command that unpacks a tar stream on stdin into the destination directory
+
+    Args:
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+    Returns:
+        bundle_cmd: command string
+    """
+    if remote_options['copy_protocol'] == 'scp':
+        return "ssh %s %s@%s 'tar -x -f - -C \"%s\"'" % (
+            ssh_options(remote_options), remote_options['user'], remote_options['host'], new_path)
+    elif remote_options['copy_protocol'] == 'cp':
+        return "tar -x -f - -C \"%s\"" % (new_path)
+    else:
+        raise NotImplementedError
+
+
+class HashingReader:
+    """File wrapper that hashes (and optionally throttles) everything read through it"""
+
+    def __init__(self, f, hasher, throttle=None):
+        self.f = f
+        self.hasher = hasher
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hasher.update(data)
+        if self.throttle is not None and data:
+            self.throttle(len(data))
+        return data
+
+
+def stream_bundle(files, bundle_cmd, algorithm='md5', throttle=None, block_size=2**20):
+    """Sends a bunch of files as one tar stream into a command that unpacks them on the other
+    end (see bundle_command), so nothing gets written to local disk and it's one process (and one
+    ssh session) for the lot. Each file is hashed on its way into the stream.
+
+    Args:
+        files: files to send
+        bundle_cmd: command to pipe the tar stream into
+        algorithm: hash algorithm to use (see hashing.new_hasher)
+        throttle: function called with the number of bytes before each block is sent
+        block_size: read size
+    Returns:
+        nbytes: number of bytes sent (not counting tar headers)
+        digests: hex digest of each file
+    """
+    start_time = time.time()
+    digests = []
+    nbytes = 0
+
+    proc = subprocess.Popen(bundle_cmd, shell=True, stdin=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdin, mode='w|', bufsize=block_size) as tar:
+            for f in files:
+                info = tar.gettarinfo(f, arcname=os.path.basename(f))
+                hasher = new_hasher(algorithm)
+                with open(f, 'rb') as f_in:
+                    tar.addfile(info, HashingReader(f_in, hasher, throttle))
+                digests.append(hasher.hexdigest())
+                nbytes += info.size
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        status = proc.wait()
+
+    if status != 0:
+        raise OSError('Bundle command exited with ' + str(status))
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    logging.info('Sent %d files in one bundle (%.1f MB in %.2f s, %.1f MB/s)' %
+                 (len(files), nbytes / 1e6, elapsed, nbytes / 1e6 / elapsed))
+
+    return nbytes, digests
+
+
+def preflight_command(files, new_path, remote_options, hash_cmd='md5sum'):
+    """Command to ask the remote end which files it already has, in one go. Only files that are there
+    with the right size get hashed, the output looks like any checksum command's
+
+    Args:
+        files: list of (file name relative to new_path, size)
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+        hash_cmd: checksum command to run (see hashing.remote_command)
+    Returns:
+        preflight_cmd: command string
+    """
+    if not is_remote(remote_options):
+        raise NotImplementedError
+
+    cmds = ['[ "$(stat -c %%s -- \"%s\" 2>/dev/null)" = "%d" ] && %s -- "%s"' % (f, size, hash_cmd, f)
+            for f, size in files]
+
+    return "ssh %s %s@%s 'cd \"%s\" 2>/dev/null && { %s; true; }'" % (
+        ssh_options(remote_options), remote_options['user'], remote_options['host'], new_path, '; '.join(cmds))
+
+
+def is_remote(remote_options):
+    """Does this protocol copy to another host?"""
+    return (remote_options['copy_protocol'] == 'scp'
+            or (remote_options['copy_protocol'] == 'rsync' and rsync_remote(remote_options)))
+
+
+def is_batch(remote_options):
+    """Can this protocol send a whole manifest with one command?"""
+    return remote_options['copy_protocol'] == 'rsync'
+
+
+def zero_copy(fd_in, fd_out, size):
+    """Copy size bytes between two file descriptors without going through user space,
+    using copy_file_range or sendfile if we have them
+
+    Args:
+        fd_in: source file descriptor
+        fd_out: destination file descriptor
+        size: number of bytes to copy
+    Returns:
+        copied: number of bytes copied
+        engine: what did the copying (copy_file_range, sendfile or read/write)
+    """
+    copied = 0
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                n = os.copy_file_range(fd_in, fd_out, min(size - copied, 2**30))
+                if n == 0:
+                    break
+                copied += n
+            return copied, 'copy_file_range'
+        except OSError as error:
+            # cross-device or unsupported filesystem, try something else
+            if error.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+
+    if hasattr(os, 'sendfile'):
+        try:
+            while copied < size:
+                n = os.sendfile(fd_out, fd_in, copied, min(size - copied, 2**30))
+                if n == 0:
+                    break
+                copied += n
+            return copied, 'sendfile'
+        except OSError as error:
+            if error.errno not in (errno.ENOSYS, errno.EINVAL):
+                raise
+
+    os.lseek(fd_in, copied, os.SEEK_SET)
+    while copied < size:
+        data = os.read(fd_in, min(size - copied, 2**20))
+        if not data:
+            break
+        os.write(fd_out, data)
+        copied += len(data)
+
+    return copied, 'read/write'
+
+
+def copy_local(f, new_path, checksum=True, block_size=2**20, throttle=None, algorithm='md5'):
+    """Copy a file into a local directory without shelling out. If we want a checksum
+    the source is hashed as it streams through, so it's only read once, otherwise
+    the kernel does the copy for us.
+
+    Args:
+        f: file to copy
+        new_path: destination directory
+        checksum: hash the source while copying
+        block_size: read size when checksumming
+        throttle: function called with the number of bytes before each block is written,
+                  blocks until we're allowed to send them
+        algorithm: hash algorithm to use (see hashing.new_hasher)
+    Returns:
+        nbytes: number of bytes written
+        digest: hex digest of the source (None if checksum is False)
+    """
+    new_file = os.path.join(new_path, os.path.basename(f))
+    start_time = time.time()
+    digest = None
+    nbytes = 0
+
+    with open(f, 'rb') as f_in, open(new_file, 'wb') as f_out:
+        if checksum or throttle is not None:
+            engine = 'hash-while-copy' if checksum else 'throttled copy'
+            hasher = new_hasher(algorithm)
+            buf = bytearray(block_size)
+            view = memoryview(buf)
+            while True:
+                n = f_in.readinto(buf)
+                if not n:
+                    break
+                if checksum:
+                    hasher.update(view[:n])
+                if throttle is not None:
+                    throttle(n)
+                f_out.write(view[:n])
+                nbytes += n
+            if checksum:
+                digest = hasher.hexdigest()
+        else:
+            nbytes, engine = zero_copy(f_in.fileno(), f_out.fileno(), os.fstat(f_in.fileno()).st_size)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    logging.info('Copied %s with %s (%.1f MB in %.2f s, %.1f MB/s)' %
+                 (os.path.basename(f), engine, nbytes / 1e6, elapsed, nbytes / 1e6 / elapsed))
+
+    return nbytes, digest
+
+
+def simulate_copy(f, remote_options):
+    """Pretends to copy a file (copy_protocol fake), for benchmarking. Waits for the
+    configured latency plus however long the file would take at the configured bandwidth.
+
+    Args:
+        f: file to "copy"
+        remote_options: remote configuration, latency in seconds and bandwidth in bytes/s
+    Returns:
+        status: 0, it always works
+    """
+    size = os.path.getsize(f)
+    delay = float(remote_options.get('latency') or 0)
+    bandwidth = remote_options.get('bandwidth')
+    if bandwidth:
+        delay += size / float(bandwidth)
+    if remote_options.get('bwlimit'):
+        throttle(remote_options['host'], size, float(remote_options['bwlimit']) * 1024)
+    time.sleep(delay)
+    return 0
+
+
+def is_local(remote_options):
+    """Does this protocol copy to the local filesystem?"""
+    return remote_options['copy_protocol'] == 'cp'
+
+
+def close_transports():
+    """Shut down any master SSH connections we opened"""
+    with _masters_lock:
+        masters = list(_masters)
+        _masters.clear()
+
+    for user, host, control_dir in masters:
+        exit_cmd = "ssh -o ControlPath=\"%s\" -O exit %s@%s 2>/dev/null" % (
+            os.path.join(control_dir, '%C'), user, host)
+        logging.info('Closing connection to ' + host)
+        os.system(exit_cmd)
@@ -0,0 +1,162 @@
+import logging
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# triggers run in the background so a slow job submission doesn't hold up the transfers
+_pool = None
+_pool_lock = threading.Lock()
+_options = {
+    'jobs': 4,
+    'timeout': None,
+    'retries': 2,
+    'retry_wait': 5
+}
+
+# key -> future for every trigger that hasn't finished yet
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def set_trigger_options(jobs=None, timeout=None, retries=None, retry_wait=None):
+    """Sets how triggers are run, has to be called before the first one goes out
+
+    Args:
+        jobs: maximum number of triggers running at once
+        timeout: seconds before a trigger is killed (None or 0 to wait forever)
+        retries: number of times to retry a trigger that fails or times out
+        retry_wait: seconds to wait before the first retry, doubles every time after that
+    """
+    if jobs is not None:
+        _options['jobs'] = max(jobs, 1)
+    if timeout is not None:
+        _options['timeout'] = timeout or None
+    if retries is not None:
+        _options['retries'] = max(retries, 0)
+    if retry_wait is not None:
+        _options['retry_wait'] = retry_wait
+
+
+def run_trigger(cmd, timeout=None, retries=0, retry_wait=5):
+    """Runs a trigger command, retrying it if it fails
+
+    Args:
+        cmd: command string
+        timeout: seconds before the command is killed (None to wait forever)
+        retries: number of times to retry
+        retry_wait: seconds to wait before the first retry, doubles every time after that
+    Returns:
+        result: dictionary with the command, status (success, failed or timeout), returncode,
+                number of attempts, time it started and how long it took all in all
+    """
+    result = {
+        'cmd': cmd,
+        'status': 'failed',
+        'returncode': None,
+        'attempts': 0,
+        'started': time.time(),
+        'duration': 0.0
+    }
+
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            wait = retry_wait * 2**(attempt - 1)
+            logging.info('Retrying command in %.0f seconds (attempt %d): %s' % (wait, attempt + 1, cmd))
+            time.sleep(wait)
+        result['attempts'] += 1
+        try:
+            result['returncode'] = subprocess.run(cmd, shell=True, timeout=timeout).returncode
+            result['status'] = 'success' if result['returncode'] == 0 else 'failed'
+        except subprocess.TimeoutExpired:
+            logging.info('Command timed out after %.0f seconds: %s' % (timeout, cmd))
+            result['returncode'] = None
+            result['status'] = 'timeout'
+        except OSError as error:
+            logging.info('Command error: ' + str(error))
+            result['status'] = 'failed'
+        if result['status'] == 'success':
+            break
+
+    result['duration'] = time.time() - result['started']
+    return result
+
+
+def _finish(key, future, callback):
+    with _pending_lock:
+        if _pending.get(key) is future:
+            del _pending[key]
+        metrics.set_gauge('dassort_triggers_pending', len(_pending))
+
+    try:
+        result = future.result()
+    except Exception as error:
+        logging.error('Trigger for ' + str(key) + ' crashed: ' + str(error))
+        return
+
+    metrics.inc('dassort_triggers_total', status=result['status'])
+    metrics.observe('dassort_trigger_seconds', result['duration'])
+    logging.info('Command %s (%s, %d attempts, %.2f s): %s' %
+                 ('SUCCESS' if result['status'] == 'success' else 'FAIL', result['status'],
+                  result['attempts'], result['duration'], result['cmd']))
+
+    if callback is not None:
+        try:
+            callback(result)
+        except Exception as error:
+            logging.error('Trigger callback for ' + str(key) + ' failed: ' + str(error))
+
+
+def submit_trigger(cmd, key=None, callback=None):
+    """Queues a trigger command to run in the background
+
+    Args:
+        cmd: command string
+        key: anything identifying what the trigger is for, see trigger_pending
+        callback: function called with the result from run_trigger once it's done
+    Returns:
+        future: future with the result from run_trigger
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=_options['jobs'])
+
+    if key is None:
+        key = cmd
+
+    with _pending_lock:
+        future = _pool.submit(run_trigger, cmd, _options['timeout'], _options['retries'], _options['retry_wait'])
+        _pending[key] = future
+        metrics.set_gauge('dassort_triggers_pending', len(_pending))
+
+    future.add_done_callback(lambda x: _finish(key, x, callback))
+    return future
+
+
+def trigger_pending(key):
+    """Is a trigger for this key still queued or running?"""
+    with _pending_lock:
+        return key in _pending
+
+
+def close_triggers(wait=True):
+    """Stops taking triggers, and waits for the ones that are already queued
+
+    Args:
+        wait: wait for queued and running triggers to finish
+    """
+    global _pool
+    with _pool_lock:
+        pool = _pool
+        _pool = None
+
+    if pool is None:
+        return
+
+    with _pending_lock:
+        n = len(_pending)
+    if wait and n > 0:
+        logging.info('Waiting for ' + str(n) + ' triggers to finish')
+    pool.shutdown(wait=wait)
@@ -5,7 +5,38 @@ import logging
 import os
 import time
 import hashlib
+import subprocess
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from itertools import cycle
+from types import MappingProxyType
+import metrics
+import tracing
+from journal import file_done, get_manifest_status, set_file_status, set_manifest_status
+from scheduler import (order_manifests, budget, retry_due, record_failure, record_success, release_changed,
+                       quarantined)
+from hashing import resolve_algorithm, remote_command, store_digest, hash_file, hash_async
+from chunked import chunked_copy_local, chunked_copy_remote
+from compress import CODECS, resolve_codec, use_compression, stored_name, compress_command, send_compressed
+from triggers import submit_trigger, trigger_pending
+from transport import (rsync_remote, dir_command, copy_command, batch_command, bundle_command, verify_command,
+                       preflight_command, is_local, is_batch, is_remote, copy_local, stream_bundle, simulate_copy,
+                       bwlimit_share)
+
+# one semaphore per destination host, shared by every worker
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+# parsed json files, path -> ((inode, mtime, size), data)
+_json_index = {}
+_json_index_lock = threading.Lock()
+
+# files we've found already at a destination when there's no journal to keep track,
+# (path, destination) -> (size, mtime)
+_present = {}
+_present_lock = threading.Lock()
 
 
 # https://stackoverflow.com/questions/1131220/get-md5-hash-of-big-files-in-python
@@ -39,8 +70,11 @@ def find_key(key, var):
                         yield result
 
 
-def read_config(file, destination=None, user=None, host=None, cmd_host=None, copy_protocol=None):
-    """Simple yaml reader to parse config files
+def read_config(file, destination=None, user=None, host=None, cmd_host=None, copy_protocol=None, bwlimit=None,
+                hash_algorithm='md5'):
+    """Simple yaml reader to parse config files. Everything that can be worked out ahead of time
+    (path and command templates, which json key goes to which path variable, router patterns)
+    is, and the configs come back read-only so they can be shared between manifests.
 
     Args:
         file: the yaml file to read the configuration from
@@ -62,7 +96,7 @@ def read_config(file, destination=None, user=None, host=None, cmd_host=None, cop
         'destination': destination,
         'command': {
             'exts': [],
-            'run': None
+            'run': []
         }
     }
 
@@ -72,7 +106,8 @@ def read_config(file, destination=None, user=None, host=None, cmd_host=None, cop
         'filter': None,
         'invert': None,
         'lowercase': None,
-        'exact': None
+        'exact': None,
+        'weights': None
     }
 
     remote_config = {
@@ -80,6 +115,23 @@ def read_config(file, destination=None, user=None, host=None, cmd_host=None, cop
         'host': host,
         'copy_protocol': copy_protocol,
         'cmd_host': cmd_host,
+        'multiplex': True,
+        'control_persist': 600,
+        'control_dir': None,
+        'checksum': True,
+        'bwlimit': bwlimit,
+        'chunk_threshold': None,
+        'chunk_size': 64 * 2**20,
+        'chunk_jobs': 4,
+        'chunk_retries': 3,
+        'bundle_threshold': None,
+        'compression': None,
+        'compression_mode': 'wire',
+        'compression_level': None,
+        'compression_min_size': 2**20,
+        'compression_max_ratio': 0.9,
+        'preflight': True,
+        'hash': hash_algorithm,
     }
 
     if 'dassort' in base_yaml.keys() and 'remote' in base_yaml.keys():
@@ -104,6 +156,7 @@ def read_config(file, destination=None, user=None, host=None, cmd_host=None, cop
         for k, v in router_config.items():
             if type(v) is not list:
                 router_config[k] = [v]
+        router_config = compile_router(router_config)
         base_config = None
         remote_config = None
     else:
@@ -121,14 +174,49 @@ def read_config(file, destination=None, user=None, host=None, cmd_host=None, cop
             'value': [],
             'path': {
                 'path_string': base_config['path'],
+                'template': compile_template(base_config['path']),
                 're': {'root': base_config['destination']}
             },
-            'command': base_config['command'],
+            # (json key, path variable) in the order manifest_path looks them up
+            'plan': list(zip(base_config['keys'], cycle(base_config['map']))),
+            'command': {
+                'exts': base_config['command']['exts'],
+                'run': base_config['command']['run'],
+                'templates': [compile_template(cmd) for cmd in base_config['command']['run']]
+            }
         }
+        base_config = freeze_config(base_config)
+
+    if remote_config is not None:
+        # bad values have to show up now, not on the first manifest (or a reload) that needs them
+        resolve_codec(remote_config['compression'])
+        resolve_algorithm(remote_config['hash'])
+        if remote_config['compression_mode'] not in ('wire', 'stored'):
+            raise ValueError('Unknown compression_mode ' + str(remote_config['compression_mode']))
+        remote_config = freeze_config(remote_config)
+
+    if router_config is not None:
+        router_config = freeze_config(router_config)
 
     return base_config, remote_config, router_config
 
 
+def freeze_config(config):
+    """Makes a config read-only, dictionaries become mapping proxies and lists become tuples
+
+    Args:
+        config: configuration (or any part of it)
+    Returns:
+        config: read-only copy
+    """
+    if isinstance(config, (dict, MappingProxyType)):
+        return MappingProxyType({k: freeze_config(v) for k, v in config.items()})
+    elif isinstance(config, (list, tuple)):
+        return tuple([freeze_config(v) for v in config])
+    else:
+        return config
+
+
 def merge_dicts(dict1, dict2):
     """Merge dictionary 2 values into dictionary 1, contingent on dictionary 1 containing
     a given key.
@@ -161,19 +249,49 @@ def build_path(key_dict, path_string):
     For example, if the path_string is ${root}/${subject} and key_dict is {'root':'cooldrive','subject':'15781'}
     the path_string is converted to cooldrive/15781
     """
-    for key, value in key_dict.items():
-        path_string = re.sub('\$\{' + key + '\}', value, path_string)
+    return render_template(compile_template(path_string), key_dict)
+
+
+def compile_template(path_string):
+    """Splits a path string into text and ${variables} once, so filling it in is just a join
+
+    Args:
+        path_string: path string with ${variables}
+    Returns:
+        template: tuple of text and variable names, variables at the odd positions
+    """
+    if path_string is None:
+        return None
+    return tuple(re.split(r'\$\{([^}]+)\}', path_string))
 
-    return path_string
 
+def render_template(template, key_dict):
+    """Fills in a template from compile_template, variables we don't have are left alone
 
-def get_listing_manifest(proc):
+    Args:
+        template: template from compile_template
+        key_dict: dictionary where each key, value pair corresponds to a variable and its value
+    Returns:
+        path_string: new path to use
+    """
+    parts = list(template)
+    for i in range(1, len(parts), 2):
+        if parts[i] in key_dict:
+            parts[i] = key_dict[parts[i]]
+        else:
+            parts[i] = '${' + parts[i] + '}'
+
+    return ''.join(parts)
+
+
+def get_listing_manifest(proc, scan=None):
     """Gets the files to ship off with a corresponding json file. If the json file lives in a sub-folder,
     all files in the folder become part of the manifest, if it does not, then all files with a matching filename
     become part of the manifest.
 
     Args:
         proc: File or directory to process
+        scan: scan from scanner.scan_source, if we have one the manifest comes from its index
     Returns:
         listing_manifest: Files to process with json file
         json_file: Json file associated with the manifest
@@ -181,6 +299,16 @@ def get_listing_manifest(proc):
     """
     # json is always LAST since it may trigger other copies...
     # https://stackoverflow.com/questions/44214910/select-the-first-n-smallest-files-from-a-folder
+    if scan is not None and proc in scan['members']:
+        members = scan['members'][proc]
+        if proc in scan['json']:
+            return members, proc
+        # sort the listing by size, we want big files in the back
+        members = sorted(members, key=lambda x: (scan['stat'][x].st_size, os.path.basename(x)))
+        tmp_json = [f for f in members if f.endswith('.json')]
+        listing_manifest = [f for f in members if not f.endswith('.json')] + tmp_json
+        return listing_manifest, tmp_json[0]
+
     if os.path.isdir(proc):
         isdir = True
         # sort the listing by size, we want big files in the back
@@ -209,31 +337,107 @@ def get_listing_manifest(proc):
     return listing_manifest, json_file
 
 
-def parse_router(router, dirs, files):
+def read_json(file):
+    """Loads a json file, unchanged files (same inode, mtime and size) come straight out of
+    the index instead of being parsed again. Don't modify what you get back, it's shared.
 
-    router_status = []
-    router_re = []
-    for filter, exact in zip(router['filter'], cycle(router['exact'])):
+    Args:
+        file: json file to read
+    Returns:
+        data: parsed json
+    """
+    stat = os.stat(file)
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    with _json_index_lock:
+        entry = _json_index.get(file)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    with open(file, 'r') as j:
+        data = json.load(j)
+
+    with _json_index_lock:
+        _json_index[file] = (key, data)
+
+    return data
+
+
+def prune_json_index(keep):
+    """Forget about json files that are no longer around
+
+    Args:
+        keep: json files to hang on to
+    """
+    keep = set(keep)
+    with _json_index_lock:
+        for file in [f for f in _json_index if f not in keep]:
+            del _json_index[file]
+
+
+def prune_present(keep):
+    """Forget about files found at a destination (see preflight) that are no longer around
+
+    Args:
+        keep: files to hang on to
+    """
+    keep = set(keep)
+    with _present_lock:
+        for key in [key for key in _present if key[0] not in keep]:
+            del _present[key]
+
+
+def compile_router(router):
+    """Compiles the router regular expressions once, so parse_router doesn't have to
+
+    Args:
+        router: router configuration from read_config
+    Returns:
+        router: same configuration with a list of (pattern, key, invert) rules
+    """
+    rules = []
+    for filter, exact, key, lowercase, invert in zip(router['filter'],
+                                                     cycle(router['exact']),
+                                                     cycle(router['key']),
+                                                     cycle(router['lowercase']),
+                                                     cycle(router['invert'])):
         if exact:
-            router_re.append(r'\b{}\b'.format(filter))
+            pattern = r'\b{}\b'.format(filter)
+        else:
+            pattern = r'{}'.format(filter)
+
+        if lowercase:
+            pattern = re.compile(pattern, re.IGNORECASE)
         else:
-            router_re.append(r'{}'.format(filter))
+            pattern = re.compile(pattern)
+
+        rules.append((pattern, key, invert))
+
+    router['rules'] = tuple(rules)
+    return router
+
+
+def parse_router(router, dirs, files):
+    """Figures out which config each directory and json file should be routed to
+
+    Args:
+        router: router configuration from read_config
+        dirs: list of lists of json files, one list per directory
+        files: json files
+    Returns:
+        router_status: index of the config to route to (None for no match), dirs first then files
+    """
+    if 'rules' not in router:
+        router = compile_router(dict(router))
+
+    router_status = []
 
     # first search directories
     for jsons in dirs:
-        js_data = []
-        for js in jsons:
-            with open(js, 'r') as j:
-                js_data.append(json.load(j))
+        js_data = [read_json(js) for js in jsons]
         dir_status = []
-        for filter, key, lowercase, invert in zip(router_re,
-                                                  cycle(router['key']),
-                                                  cycle(router['lowercase']),
-                                                  cycle(router['invert'])):
-            if lowercase:
-                hits = [re.search(filter, j[key], re.IGNORECASE) is not None for j in js_data]
-            else:
-                hits = [re.search(filter, j[key]) is not None for j in js_data]
+        for pattern, key, invert in router['rules']:
+            hits = [pattern.search(j[key]) is not None for j in js_data]
 
             if invert:
                 dir_status.append(not any(hits))
@@ -248,22 +452,15 @@ def parse_router(router, dirs, files):
     # then search files
     for js in files:
 
-        with open(js, 'r') as j:
-            js_data = json.load(j)
+        js_data = read_json(js)
 
         if js_data is None:
+            router_status.append(None)
             continue
 
         file_status = []
-        for filter, key, lowercase, invert in zip(router_re,
-                                                  cycle(router['key']),
-                                                  cycle(router['lowercase']),
-                                                  cycle(router['invert'])):
-
-            if lowercase:
-                hit = re.search(filter, js_data[key], re.IGNORECASE)
-            else:
-                hit = re.search(filter, js_data[key])
+        for pattern, key, invert in router['rules']:
+            hit = pattern.search(js_data[key]) is not None
 
             if invert:
                 hit = not hit
@@ -277,180 +474,1153 @@ def parse_router(router, dirs, files):
     return router_status
 
 
-def proc_loop(listing, base_dict, dry_run, delete, remote_options):
-    """Main processing loop
+def snapshot_manifest(listing_manifest, stats=None):
+    """Grab size, mtime and inode for every file in a manifest so we can tell if anything
+    is still being written
 
+    Args:
+        listing_manifest: list of files in the manifest
+        stats: stat results we already have (e.g. from a scan), path -> stat result
+    Returns:
+        snapshot: dictionary of file -> (size, mtime, inode)
     """
-    proc_count = 0
-    for proc in listing:
+    snapshot = {}
+    for f in listing_manifest:
+        try:
+            if stats is not None and f in stats:
+                stat = stats[f]
+            else:
+                stat = os.stat(f)
+        except OSError:
+            # file vanished between listing and stat, count it as a change
+            continue
+        snapshot[f] = (stat.st_size, stat.st_mtime, stat.st_ino)
+
+    return snapshot
 
-        use_dict = base_dict
 
-        logging.info('Processing ' + proc)
-        sz = os.path.getsize(proc)
+def check_stability(tracker, listing, settle_time, now=None, scan=None):
+    """Snapshot every candidate in one pass and figure out which ones have been quiet
+    for at least settle_time seconds. The tracker is kept between calls, so nobody has
+    to sit around and wait.
 
-        # loop through manifest, make sure the files are not growing...
+    Args:
+        tracker: dictionary kept between cycles, proc -> {'snapshot', 'since', 'ready'}
+        listing: files or directories to check
+        settle_time: how long (in seconds) a manifest must remain unchanged
+        now: current time, defaults to time.time()
+        scan: scan from scanner.scan_source, saves us listing and stat-ing everything again
+    Returns:
+        ready: dictionary of proc -> (listing_manifest, json_file) for stable manifests
+    """
+    if now is None:
+        now = time.time()
 
-        listing_manifest, json_file = get_listing_manifest(proc=proc)
+    ready = {}
+    for proc in listing:
+        try:
+            listing_manifest, json_file = get_listing_manifest(proc=proc, scan=scan)
+        except (OSError, IndexError):
+            tracker.pop(proc, None)
+            continue
 
         # changed from <= 1 to < 1 to account for metadata.json getting orphaned...
         if len(listing_manifest) < 1:
             logging.info(
                 'Manifest empty, continuing...(maybe files still copying?)')
+            tracker.pop(proc, None)
             continue
 
-        logging.info('Getting file sizes for manifest')
-        listing_sz = {f: os.path.getsize(f) for f in listing_manifest}
-        time.sleep(30)
-        listing_manifest, json_file = get_listing_manifest(proc=proc)
-        logging.info('Checking file sizes again')
-        listing_sz2 = {f: os.path.getsize(f) for f in listing_manifest}
+        if scan is not None:
+            snapshot = snapshot_manifest(listing_manifest, stats=scan['stat'])
+        else:
+            snapshot = snapshot_manifest(listing_manifest)
+        entry = tracker.get(proc)
 
-        if listing_sz != listing_sz2:
-            logging.info(
-                'A file size changed or a new file was added, continuing...')
-            continue
+        if entry is None or entry['snapshot'] != snapshot:
+            if entry is not None:
+                logging.info('A file changed or a new file was added to ' + proc + ', waiting...')
+            first = now if entry is None else entry['first']
+            tracker[proc] = {'snapshot': snapshot, 'since': now, 'first': first, 'ready': False}
+        elif now - entry['since'] >= settle_time:
+            if not entry['ready']:
+                metrics.observe('dassort_stability_wait_seconds', now - entry['first'])
+                tracing.add_span('stability wait', entry['first'], now - entry['first'], session=proc)
+            entry['ready'] = True
+            ready[proc] = (listing_manifest, json_file)
+
+    return ready
+
+
+def get_host_slot(host, host_jobs=None):
+    """Gets the semaphore limiting the number of concurrent transfers to a host
+
+    Args:
+        host: destination host
+        host_jobs: maximum number of concurrent transfers to the host, None for no limit
+    Returns:
+        slot: semaphore (or a do-nothing lock if there's no limit)
+    """
+    if host_jobs is None or host_jobs < 1:
+        return nullcontext()
+
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(host_jobs)
+        return _host_slots[host]
+
+
+def map_jobs(pool, fun, items):
+    """Runs fun on items using a thread pool if we have one, otherwise one after another"""
+    if pool is None:
+        return [fun(item) for item in items]
+    else:
+        return list(pool.map(fun, items))
+
+
+def record_transfer(protocol, host, nbytes, transfer_time, success, nfiles=1):
+    """Updates the transfer metrics
+
+    Args:
+        protocol: copy protocol
+        host: destination host
+        nbytes: bytes transferred
+        transfer_time: time it took (seconds)
+        success: did it work?
+        nfiles: number of files in the transfer
+    """
+    if success:
+        metrics.inc('dassort_bytes_total', nbytes, protocol=protocol, host=host)
+        metrics.inc('dassort_files_total', nfiles, protocol=protocol, host=host, status='copied')
+        metrics.observe('dassort_transfer_seconds', transfer_time, protocol=protocol, host=host)
+        metrics.set_gauge('dassort_throughput_bytes_per_second', nbytes / max(transfer_time, 1e-6),
+                          protocol=protocol, host=host)
+    else:
+        metrics.inc('dassort_files_total', nfiles, protocol=protocol, host=host, status='failed')
+
+
+def host_throttle(host, remote_options):
+    """Function that keeps anything we stream ourselves to its share of the host's bandwidth cap,
+    same as scp or rsync get (see transport.bwlimit_share). Every transfer holds one of the host's
+    slots, so the shares add up to the cap. Call it once per transfer, everything sent with it
+    shares the budget. None if there's no cap"""
+    share = bwlimit_share(remote_options)
+    if share is None:
+        return None
+    return budget(share * 1024)
+
+
+def use_chunks(f, remote_options):
+    """Should this file go in parallel chunks? Only if it's over the configured threshold
+
+    Args:
+        f: file to copy
+        remote_options: remote configuration from read_config
+    Returns:
+        chunked: True if we should chunk it
+    """
+    threshold = remote_options.get('chunk_threshold')
+    if threshold is None or remote_options['copy_protocol'] not in ('cp', 'scp', 'rsync'):
+        return False
+    return os.path.getsize(f) >= threshold
+
+
+def use_bundle(f, remote_options):
+    """Should this file go in a tar stream with the other small files in its manifest? Only if
+    it's under the configured threshold (and isn't going in chunks)
+
+    Args:
+        f: file to copy
+        remote_options: remote configuration from read_config
+    Returns:
+        bundled: True if we should bundle it
+    """
+    threshold = remote_options.get('bundle_threshold')
+    if threshold is None or remote_options['copy_protocol'] not in ('cp', 'scp'):
+        return False
+    return os.path.getsize(f) < threshold and not use_chunks(f, remote_options)
+
+
+def transfer_file(f, new_path, remote_options, dry_run, delete, host_jobs=None, journal=None, proc=None,
+                  verify_later=False, codec=None):
+    """Copies a single file to its destination
+
+    Args:
+        f: file to copy
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+        dry_run: log what we would do but don't do it
+        delete: delete the file after a successful copy
+        host_jobs: maximum number of concurrent transfers per destination host
+        journal: transfer journal from open_journal, files it has already verified are skipped
+        proc: file or directory the manifest belongs to (for the journal)
+        verify_later: the caller checks the copy itself (see verify_remote), so it only goes in the
+                      journal as copied
+        codec: compression to send it with (see compress.use_compression), None to send it as is
+    Returns:
+        success: True if the file made it, False if it didn't, None on a dry run or if it was skipped
+    """
+    if journal is not None and file_done(journal, f, new_path):
+        logging.info('Already copied ' + f + ', skipping')
+        if delete and not dry_run:
+            os.remove(f)
+        return None
+
+    local_copy = is_local(remote_options)
+    chunked = use_chunks(f, remote_options)
+    if chunked:
+        codec = None
+
+    if chunked:
+        cp_cmd = 'chunked copy of "%s" to "%s"' % (f, new_path)
+    elif codec is not None:
+        cp_cmd = compress_command(f, new_path, remote_options, codec)
+    elif local_copy:
+        # no cp involved, see copy_local for what actually does the copying
+        cp_cmd = 'in-process copy of "%s" to "%s"' % (f, new_path)
+    else:
+        cp_cmd = copy_command(f, new_path, remote_options)
+
+    logging.info('Copy command: ' + cp_cmd)
+
+    if dry_run:
+        if delete:
+            logging.info('Would delete: ' + f)
+        return None
+
+    if local_copy:
+        host = 'localhost'
+    else:
+        host = remote_options['host']
+
+    if journal is not None:
+        set_file_status(journal, f, proc, new_path, 'copying')
+
+    md5_original = None
+    nbytes = os.path.getsize(f)
+
+    if chunked:
+        # every chunk gets checked on its own, so no need to checksum the whole thing again
+        chunk_options = {
+            'chunk_size': remote_options.get('chunk_size') or 64 * 2**20,
+            'jobs': remote_options.get('chunk_jobs') or 4,
+            'retries': remote_options.get('chunk_retries', 3),
+            # every chunk stream draws from the same per-host budget
+            'throttle': host_throttle(host, remote_options)
+        }
+        with get_host_slot(host, host_jobs):
+            start_time = time.time()
+            try:
+                if local_copy or (remote_options['copy_protocol'] == 'rsync' and not rsync_remote(remote_options)):
+                    copied = chunked_copy_local(f, new_path, **chunk_options)
+                elif verify_later:
+                    # the whole-file digest gets worked out right behind the chunks, while they're still
+                    # in the page cache, and it ends up in the hash cache for verify_remote
+                    digest = hash_async(f, resolve_algorithm(remote_options.get('hash')))
+                    copied = chunked_copy_remote(f, new_path, remote_options, **chunk_options)
+                    md5_original = digest.result()
+                else:
+                    copied = chunked_copy_remote(f, new_path, remote_options, **chunk_options)
+            except OSError as error:
+                logging.info('Copy error: ' + str(error))
+                copied = None
+            transfer_time = time.time() - start_time
+        status = 0 if copied is not None else 1
+    elif codec is not None:
+        algorithm = resolve_algorithm(remote_options.get('hash'))
+        with get_host_slot(host, host_jobs):
+            start_time = time.time()
+            try:
+                nbytes, _, md5_original = send_compressed(f, cp_cmd, codec,
+                                                          level=remote_options.get('compression_level'),
+                                                          algorithm=algorithm,
+                                                          throttle=host_throttle(host, remote_options))
+                status = 0
+            except OSError as error:
+                logging.info('Copy error: ' + str(error))
+                status = 1
+            transfer_time = time.time() - start_time
+        if status == 0:
+            # hashed on the way through, verify_remote can have it for free
+            store_digest(f, algorithm, md5_original)
+    elif local_copy:
+        checksum = remote_options.get('checksum', True)
+        algorithm = resolve_algorithm(remote_options.get('hash'))
+        local_throttle = host_throttle(host, remote_options)
+
+        with get_host_slot(host, host_jobs):
+            start_time = time.time()
+            try:
+                nbytes, md5_original = copy_local(f, new_path, checksum=checksum, throttle=local_throttle,
+                                                  algorithm=algorithm)
+                status = 0
+            except OSError as error:
+                logging.info('Copy error: ' + str(error))
+                status = 1
+            transfer_time = time.time() - start_time
+
+        if status == 0:
+            # source was hashed on the way through, so we only need to read the copy
+            logging.info('Checking file integrity...')
+            new_file = os.path.join(new_path, os.path.basename(f))
+            if os.path.getsize(new_file) != nbytes or os.path.getsize(f) != nbytes:
+                logging.info('Size mismatch')
+                status = 1
+            elif checksum:
+                # keep the source's hash around in case we need it again, then check the copy in the
+                # hashing pool so the host slot is free for the next transfer
+                store_digest(f, algorithm, md5_original)
+                start_time = time.time()
+                with tracing.span('checksum', file=os.path.basename(f)):
+                    md5_copy = hash_async(new_file, algorithm, use_cache=False).result()
+                metrics.observe('dassort_checksum_seconds', time.time() - start_time, algorithm=algorithm)
+                md5checksum = md5_original == md5_copy
+                logging.info('Checksum (' + algorithm + '): ' + str(md5checksum))
+                if not md5checksum:
+                    status = 1
+    elif remote_options['copy_protocol'] == 'fake':
+        with get_host_slot(host, host_jobs):
+            start_time = time.time()
+            status = simulate_copy(f, remote_options)
+            transfer_time = time.time() - start_time
+    else:
+        with get_host_slot(host, host_jobs):
+            start_time = time.time()
+            status = os.system(cp_cmd)
+            transfer_time = time.time() - start_time
+
+    record_transfer(remote_options['copy_protocol'], host, nbytes, transfer_time, status == 0)
+
+    if journal is not None:
+        if status != 0:
+            file_status = 'pending'
+        elif verify_later:
+            file_status = 'copied'
+        else:
+            file_status = 'verified'
+        set_file_status(journal, f, proc, new_path, file_status, digest=md5_original)
+
+    if status == 0 and delete:
+        logging.info('Copy succeeded, deleting file')
+        os.remove(f)
+    elif status == 0:
+        logging.info('Copy SUCCESS, continuing')
+    else:
+        logging.info('Copy FAILED, continuing')
+
+    return status == 0
+
+
+def journal_transfer(transfer, files, new_path, remote_options, dry_run, delete, host_jobs=None, journal=None,
+                     proc=None, verify_later=False):
+    """Runs a transfer of several files (transfer_batch or transfer_bundle) on just the ones the journal
+    hasn't seen verified yet, and records how the rest went
+
+    Args:
+        transfer: transfer_batch or transfer_bundle
+        files: files to copy
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+        dry_run: log what we would do but don't do it
+        delete: delete the files after a successful copy
+        host_jobs: maximum number of concurrent transfers per destination host
+        journal: transfer journal from open_journal
+        proc: file or directory the manifest belongs to (for the journal)
+        verify_later: the caller checks the copies itself (see verify_remote), so they only go in the
+                      journal as copied
+    Returns:
+        success: list with True if the file made it, False if it didn't, None on a dry run or if it was skipped
+    """
+    done = [file_done(journal, f, new_path) for f in files]
+    for f in [f for f, d in zip(files, done) if d]:
+        logging.info('Already copied ' + f + ', skipping')
+        if delete and not dry_run:
+            os.remove(f)
+    status = transfer([f for f, d in zip(files, done) if not d], new_path, remote_options, dry_run, delete,
+                      host_jobs=host_jobs)
+    status = iter(status)
+    status = [None if d else next(status) for d in done]
+    for f, st in zip(files, status):
+        if st is not None and not dry_run:
+            set_file_status(journal, f, proc, new_path,
+                            'pending' if not st else 'copied' if verify_later else 'verified')
+    return status
+
+
+def transfer_batch(files, new_path, remote_options, dry_run, delete, host_jobs=None, journal=None, proc=None,
+                   verify_later=False):
+    """Copies a batch of files to their destination with a single command
+
+    Args:
+        files: files to copy
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+        dry_run: log what we would do but don't do it
+        delete: delete the files after a successful copy
+        host_jobs: maximum number of concurrent transfers per destination host
+        journal: transfer journal from open_journal, files it has already verified are skipped
+        proc: file or directory the manifest belongs to (for the journal)
+        verify_later: the caller checks the copies itself (see verify_remote), so they only go in the
+                      journal as copied
+    Returns:
+        success: list with True if the file made it, False if it didn't, None on a dry run or if it was skipped
+    """
+    if journal is not None:
+        return journal_transfer(transfer_batch, files, new_path, remote_options, dry_run, delete, host_jobs=host_jobs,
+                                journal=journal, proc=proc, verify_later=verify_later)
+
+    if len(files) == 0:
+        return []
+
+    cp_cmd = batch_command(files, new_path, remote_options)
+    logging.info('Copy command: ' + cp_cmd)
+
+    if dry_run:
+        if delete:
+            [logging.info('Would delete: ' + f) for f in files]
+        return [None for f in files]
+
+    host = remote_options.get('host') or 'localhost'
+    nbytes = sum([os.path.getsize(f) for f in files])
+
+    with get_host_slot(host, host_jobs):
+        start_time = time.time()
+        status = os.system(cp_cmd)
+        transfer_time = time.time() - start_time
+
+    record_transfer(remote_options['copy_protocol'], host, nbytes, transfer_time, status == 0, nfiles=len(files))
+
+    if status == 0 and delete:
+        logging.info('Copy succeeded, deleting files')
+        [os.remove(f) for f in files]
+    elif status == 0:
+        logging.info('Copy SUCCESS, continuing')
+    else:
+        logging.info('Copy FAILED, continuing')
+
+    return [status == 0 for f in files]
 
-        missing_files = False
 
-        if base_dict['required_files'] is not None and len(base_dict['required_files']) > 0:
-            basenames = [os.path.basename(_) for _ in listing_manifest]
-            for required_file in base_dict['required_files']:
-                if required_file not in basenames:
-                    logging.info('Could not find ' + required_file)
-                    missing_files = True
+def transfer_bundle(files, new_path, remote_options, dry_run, delete, host_jobs=None, journal=None, proc=None,
+                    verify_later=False):
+    """Copies a bunch of small files to their destination as one tar stream, unpacked on the other end
 
-        if missing_files:
-            logging.info('File missing, continuing...')
+    Args:
+        files: files to copy
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+        dry_run: log what we would do but don't do it
+        delete: delete the files after a successful copy
+        host_jobs: maximum number of concurrent transfers per destination host
+        journal: transfer journal from open_journal, files it has already verified are skipped
+        proc: file or directory the manifest belongs to (for the journal)
+        verify_later: the caller checks the copies itself (see verify_remote), so they only go in the
+                      journal as copied
+    Returns:
+        success: list with True if the file made it, False if it didn't, None on a dry run or if it was skipped
+    """
+    if journal is not None:
+        return journal_transfer(transfer_bundle, files, new_path, remote_options, dry_run, delete, host_jobs=host_jobs,
+                                journal=journal, proc=proc, verify_later=verify_later)
+
+    if len(files) == 0:
+        return []
+
+    cp_cmd = bundle_command(new_path, remote_options)
+    logging.info('Bundle command: ' + cp_cmd + ' [' + ','.join([os.path.basename(f) for f in files]) + ']')
+
+    if dry_run:
+        if delete:
+            [logging.info('Would delete: ' + f) for f in files]
+        return [None for f in files]
+
+    local_copy = is_local(remote_options)
+    host = 'localhost' if local_copy else remote_options['host']
+    checksum = remote_options.get('checksum', True)
+    algorithm = resolve_algorithm(remote_options.get('hash'))
+
+    bundle_throttle = host_throttle(host, remote_options)
+
+    with get_host_slot(host, host_jobs):
+        start_time = time.time()
+        try:
+            nbytes, digests = stream_bundle(files, cp_cmd, algorithm=algorithm, throttle=bundle_throttle)
+            status = [True for f in files]
+        except (OSError, tarfile.TarError) as error:
+            logging.info('Bundle error: ' + str(error))
+            nbytes = sum([os.path.getsize(f) for f in files])
+            digests = [None for f in files]
+            status = [False for f in files]
+        transfer_time = time.time() - start_time
+
+    record_transfer(remote_options['copy_protocol'], host, nbytes, transfer_time, all(status), nfiles=len(files))
+
+    if all(status):
+        # sources were hashed on their way into the stream, keep them for verify_remote
+        for f, digest in zip(files, digests):
+            store_digest(f, algorithm, digest)
+
+    if all(status) and local_copy and checksum:
+        logging.info('Checking file integrity...')
+        start_time = time.time()
+        with tracing.span('checksum', files=len(files)):
+            status = [hash_file(os.path.join(new_path, os.path.basename(f)), algorithm, use_cache=False) == digest
+                      for f, digest in zip(files, digests)]
+        metrics.observe('dassort_checksum_seconds', time.time() - start_time, algorithm=algorithm)
+        logging.info('Checksum (' + algorithm + '): ' + str(status.count(True)) + ' of ' + str(len(files)) +
+                     ' files match')
+
+    if all(status) and delete:
+        logging.info('Copy succeeded, deleting files')
+        [os.remove(f) for f in files]
+    elif all(status):
+        logging.info('Copy SUCCESS, continuing')
+    else:
+        logging.info('Copy FAILED, continuing')
+
+    return status
+
+
+def verify_remote(files, status, new_path, remote_options, digests, delete, host_jobs=None, journal=None,
+                  proc=None, codecs=None):
+    """Checks a whole batch of remote copies against their local hashes with one command, then
+    deletes the originals that check out (if we're deleting)
+
+    Args:
+        files: files that were sent
+        status: what transfer_file/transfer_batch said about each of them
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+        digests: dictionary of file -> future with its local digest (see hashing.hash_async)
+        delete: delete the files once they're verified
+        host_jobs: maximum number of concurrent transfers per destination host
+        journal: transfer journal from open_journal
+        proc: file or directory the manifest belongs to (for the journal)
+        codecs: dictionary of file -> codec it was sent with, files that aren't in there went as is
+    Returns:
+        success: status, with any file that didn't match set to False
+    """
+    algorithm = resolve_algorithm(remote_options.get('hash'))
+    check = [f for f, st in zip(files, status) if st]
+    if codecs is None:
+        codecs = {}
+
+    if len(check) > 0:
+        # anything stored compressed gets unpacked on the other end to check it
+        stored = {}
+        for f in check:
+            codec = codecs.get(f)
+            if stored_name(f, codec, remote_options) != os.path.basename(f):
+                stored[os.path.basename(f)] = (stored_name(f, codec, remote_options), CODECS[codec][1])
+        verify_cmd = verify_command([os.path.basename(f) for f in check], new_path, remote_options,
+                                    remote_command(algorithm), stored=stored)
+        logging.info('Verify command: ' + verify_cmd)
+
+        with get_host_slot(remote_options['host'], host_jobs), tracing.span('checksum', files=len(check)):
+            start_time = time.time()
+            result = subprocess.run(verify_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            metrics.observe('dassort_checksum_seconds', time.time() - start_time, algorithm=algorithm)
+
+        # md5sum and friends print "digest  name" (or "digest *name" in binary mode)
+        remote_digests = {}
+        for line in result.stdout.decode(errors='replace').splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                remote_digests[fields[1].lstrip('*')] = fields[0]
+
+        matched = {}
+        for f in check:
+            try:
+                digest = digests[f].result()
+            except OSError as error:
+                logging.info('Could not hash ' + f + ': ' + str(error))
+                digest = None
+            matched[f] = digest is not None and remote_digests.get(os.path.basename(f)) == digest
+            if journal is not None:
+                set_file_status(journal, f, proc, new_path, 'verified' if matched[f] else 'pending', digest=digest)
+
+        logging.info('Checksum (' + algorithm + '): ' + str(list(matched.values()).count(True)) + ' of ' +
+                     str(len(check)) + ' files match')
+        for f in [f for f in check if not matched[f]]:
+            logging.info('Checksum mismatch ' + f)
+            metrics.inc('dassort_files_total', status='corrupt')
+
+        status = [matched[f] if f in matched else st for f, st in zip(files, status)]
+
+    # skipped files (None) were verified on an earlier pass
+    if delete:
+        for f in [f for f, st in zip(files, status) if st is not False]:
+            logging.info('Verified, deleting ' + f)
+            os.remove(f)
+
+    return status
+
+
+def preflight(files, new_path, remote_options, host_jobs=None, journal=None, proc=None, codecs=None):
+    """Checks which files are already at the destination (same size and hash) so we don't send them
+    again. Remote destinations get asked about the whole lot in one command, and only hash the files
+    that are the right size. Whatever we find is recorded (in the journal, or in memory without one)
+    so later passes don't have to ask.
+
+    Args:
+        files: files to check
+        new_path: destination directory
+        remote_options: remote configuration from read_config
+        host_jobs: maximum number of concurrent transfers per destination host
+        journal: transfer journal from open_journal
+        proc: file or directory the manifest belongs to (for the journal)
+        codecs: dictionary of file -> codec it'll be sent with, files that aren't in there go as is
+    Returns:
+        present: set of files that are already there
+    """
+    algorithm = resolve_algorithm(remote_options.get('hash'))
+    if codecs is None:
+        codecs = {}
+
+    present = set()
+    check = []
+    for f in files:
+        try:
+            stat = os.stat(f)
+        except OSError:
+            continue
+        if journal is not None:
+            known = file_done(journal, f, new_path)
+        else:
+            with _present_lock:
+                known = _present.get((f, new_path)) == (stat.st_size, stat.st_mtime_ns)
+        if known:
+            present.add(f)
+        # anything stored compressed has another name over there, just send it
+        elif stored_name(f, codecs.get(f), remote_options) == os.path.basename(f):
+            check.append((f, stat.st_size))
+
+    found = {}
+    if is_remote(remote_options) and len(check) > 0:
+        preflight_cmd = preflight_command([(os.path.basename(f), size) for f, size in check], new_path,
+                                          remote_options, remote_command(algorithm))
+        logging.info('Preflight command: ' + preflight_cmd)
+        with get_host_slot(remote_options['host'], host_jobs):
+            result = subprocess.run(preflight_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for line in result.stdout.decode(errors='replace').splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                found[fields[1].lstrip('*')] = fields[0]
+    elif not is_remote(remote_options):
+        for f, size in check:
+            new_file = os.path.join(new_path, os.path.basename(f))
+            try:
+                if os.path.isfile(new_file) and os.path.getsize(new_file) == size:
+                    found[os.path.basename(f)] = hash_file(new_file, algorithm, use_cache=False)
+            except OSError:
+                continue
+
+    for f, size in check:
+        digest = found.get(os.path.basename(f))
+        if digest is None:
             continue
+        try:
+            if digest != hash_file(f, algorithm):
+                continue
+            mtime = os.stat(f).st_mtime_ns
+        except OSError as error:
+            # gone from under us, nothing to send anyway
+            logging.info('Could not hash ' + f + ': ' + str(error))
+            continue
+        present.add(f)
+        if journal is not None:
+            set_file_status(journal, f, proc, new_path, 'verified', digest=digest)
+        else:
+            with _present_lock:
+                _present[(f, new_path)] = (size, mtime)
 
-        logging.info('Found json file ' + json_file)
+    if len(present) > 0:
+        logging.info(str(len(present)) + ' of ' + str(len(files)) + ' files already at ' + new_path + ', skipping them')
+        metrics.inc('dassort_files_total', len(present), status='present')
 
-        with open(json_file) as open_file:
-            dict_json = json.load(open_file)
+    return present
 
-        if 'destination' in dict_json:
-            use_dict['path']['re']['root'] = dict_json['destination']
 
-        # if it's a directory the manifest is the contents of the directory, if it's not the manifest
-        # simply matches filenames
+def manifest_path(proc, json_file, base_dict):
+    """Pulls the keys out of a manifest's json file and builds the path to send it to
 
-        logging.info('Manifest [' + ','.join(listing_manifest) + ']')
-        generators = []
+    Args:
+        proc: file or directory the manifest belongs to
+        json_file: json file associated with the manifest
+        base_dict: configuration from read_config
+    Returns:
+        new_path: destination directory
+        context: the manifest's own path variables
+    """
+    # the config is shared (and read-only), each manifest fills in its own variables
+    context = dict(base_dict['path']['re'])
+
+    dict_json = read_json(json_file)
+
+    if 'destination' in dict_json:
+        context['root'] = dict_json['destination']
+
+    for m, d in zip(base_dict['map'], base_dict['default']):
+        context[m] = d
+
+    for k, v in base_dict['plan']:
+        context[v] = next(find_key(k, dict_json), context[v])
+
+    # sub folder is a special key to copy over the appropriate sub-folder
+
+    if os.path.isdir(proc):
+        context['sub_folder'] = os.path.basename(
+            os.path.normpath(proc)) + '/'
+    else:
+        context['sub_folder'] = ''
+
+    # build a path
+    new_path = render_template(base_dict['path']['template'], context)
+
+    return new_path, context
+
+
+def proc_manifest(proc, listing_manifest, json_file, base_dict, dry_run, delete, remote_options,
+                  file_pool=None, host_jobs=None, journal=None, outcome=None, on_trigger=None):
+    """Sends a single manifest to its destination and issues any command triggers
+
+    Args:
+        proc: file or directory the manifest belongs to
+        listing_manifest: files to process with the json file
+        json_file: json file associated with the manifest
+        base_dict: configuration from read_config
+        dry_run: log what we would do but don't do it
+        delete: delete files after a successful copy
+        remote_options: remote configuration from read_config
+        file_pool: thread pool used to copy files within the manifest concurrently
+        host_jobs: maximum number of concurrent transfers per destination host
+        journal: transfer journal from open_journal, lets us skip work that's already done
+        outcome: dictionary to put how it went in, proc -> missing (required files), failed,
+                 triggering (commands still out) or done
+        on_trigger: function called with proc and True (or False if any of them failed) once the
+                    command triggers are all back
+    Returns:
+        proc_count: number of files copied
+    """
+    proc_count = 0
+    start_time = time.time()
+
+    if outcome is None:
+        outcome = {}
+
+    logging.info('Processing ' + proc)
+
+    missing_files = False
+
+    if base_dict['required_files'] is not None and len(base_dict['required_files']) > 0:
+        basenames = [os.path.basename(_) for _ in listing_manifest]
+        for required_file in base_dict['required_files']:
+            if required_file not in basenames:
+                logging.info('Could not find ' + required_file)
+                missing_files = True
+
+    if missing_files:
+        logging.info('File missing, continuing...')
+        outcome[proc] = 'missing'
+        return proc_count
+
+    logging.info('Found json file ' + json_file)
+
+    # if it's a directory the manifest is the contents of the directory, if it's not the manifest
+    # simply matches filenames
+
+    logging.info('Manifest [' + ','.join(listing_manifest) + ']')
+
+    with tracing.span('parse json'):
+        new_path, _ = manifest_path(proc, json_file, base_dict)
+
+    logging.info('Sending manifest to ' + new_path)
+
+    if journal is not None:
+        already_triggered = get_manifest_status(journal, proc) == ('triggered', new_path)
+        if not dry_run and not already_triggered:
+            set_manifest_status(journal, proc, json_file, new_path, 'copying')
+    else:
+        already_triggered = False
 
-        for m, d in zip(use_dict['map'], use_dict['default']):
-            use_dict['path']['re'][m] = d
+    # everything but the json goes at once, json is always LAST since it may trigger other copies...
 
-        for k, v in zip(use_dict['keys'], cycle(use_dict['map'])):
-            generators = find_key(k, dict_json)
-            use_dict['path']['re'][v] = next(
-                generators, use_dict['path']['re'][v])
+    # the destination is the same for the whole manifest, only check it once
 
-        # sub folder is a special key to copy over the appropriate sub-folder
+    dir_cmd = dir_command(new_path, remote_options)
+    logging.info('Chk command:  ' + dir_cmd)
 
-        if os.path.isdir(proc):
-            use_dict['path']['re']['sub_folder'] = os.path.basename(
-                os.path.normpath(proc)) + '/'
+    if not dry_run:
+        with tracing.span('mkdir'):
+            status = os.system(dir_cmd)
+        if status == 0:
+            logging.info('Directory creation/check succesful, copying...')
         else:
-            use_dict['path']['re']['sub_folder'] = ''
-
-        # build a path
-        new_path = build_path(
-            use_dict['path']['re'], use_dict['path']['path_string'])
-        # check for command triggers
-
-        logging.info('Sending manifest to ' + new_path)
-
-        # aiight dawg, one trigger per manifest?
-
-        for f in listing_manifest:
-            if remote_options['copy_protocol'] == 'scp':
-                # dir check
-                local_copy = False
-                dir_cmd = "ssh %s@%s 'mkdir -p \"%s\"'" % (
-                    remote_options['user'], remote_options['host'], new_path)
-                cp_cmd = "scp \"%s\" %s@%s:'\"%s\"'" % (
-                    f, remote_options['user'], remote_options['host'], new_path)
-            elif remote_options['copy_protocol'] == 'nocopy':
-                local_copy = False
-                dir_cmd = ''
-                cp_cmd = ''
-            elif remote_options['copy_protocol'] == 'rsync':
-                local_copy = False
-                raise NotImplementedError
-            elif remote_options['copy_protocol'] == 'cp':
-                local_copy = True
-                dir_cmd = "mkdir -p \"%s\"" % (new_path)
-                cp_cmd = "cp \"%s\" \"%s\"" % (f, new_path)
-            else:
-                raise NotImplementedError
-
-            logging.info('Chk command:  ' + dir_cmd)
-            logging.info('Copy command: ' + cp_cmd)
-
-            if not dry_run:
-                status = os.system(dir_cmd)
-
-                if status == 0:
-                    logging.info(
-                        'Directory creation/check succesful, copying...')
-                    status = os.system(cp_cmd)
-
-                if local_copy:
-                    # check md5
-                    logging.info('Checking file integrity...')
-                    with open(f, 'rb') as f_check:
-                        md5_original = md5_checksum(f_check)
-                    new_file = os.path.join(new_path, os.path.basename(f))
-                    with open(new_file, 'rb') as f_check:
-                        md5_copy = md5_checksum(f_check)
-                    md5checksum = md5_original == md5_copy
-                    logging.info('MD5checksum: ' + str(md5checksum))
-                    status = status & (not md5checksum)
-
-                if status == 0 and delete:
-                    logging.info('Copy succeeded, deleting file')
-                    proc_count += 1
-                    os.remove(os.path.join(new_path, f))
-                elif status == 0:
-                    logging.info('Copy SUCCESS, continuing')
-                    proc_count += 1
-                else:
-                    logging.info('Copy FAILED, continuing')
-                    continue
-            elif dry_run and delete:
-                logging.info('Would delete: ' + os.path.join(new_path, f))
-
-        issue_options = {
-            'user': '',
-            'host': '',
-            'cmd_host': '',
-            'path': ''
-        }
+            logging.info('Directory creation/check FAILED, continuing')
+            outcome[proc] = 'failed'
+            return proc_count
+
+    # small files go in one tar stream, so they cost one process (and ssh session) between them
+    bundled = [f for f in listing_manifest if not f.endswith('.json') and use_bundle(f, remote_options)]
+    if len(bundled) < 2:
+        bundled = []
+
+    # how each file goes is settled here once, chunked and bundled files are never compressed, and
+    # everything downstream has to agree on what name the file ends up under
+    codecs = {f: None if f in bundled or use_chunks(f, remote_options) else use_compression(f, remote_options)
+              for f in listing_manifest}
+
+    # anything that's already there doesn't need to go again
+    if not dry_run and remote_options.get('preflight', True) and remote_options['copy_protocol'] in ('cp', 'scp'):
+        with tracing.span('preflight', files=len(listing_manifest)):
+            present = preflight(listing_manifest, new_path, remote_options, host_jobs=host_jobs, journal=journal,
+                                proc=proc, codecs=codecs)
+    else:
+        present = set()
+
+    payload = [f for f in listing_manifest if not f.endswith('.json') and f not in present]
+    payload_json = [f for f in listing_manifest if f.endswith('.json') and f not in present]
+    bundled = [f for f in bundled if f not in present]
+
+    # those can go right away, the json still waits for the rest
+    if delete:
+        for f in [f for f in listing_manifest if f in present and not f.endswith('.json')]:
+            logging.info('Already at destination, deleting ' + f)
+            os.remove(f)
+
+    # remote copies only count once a single batched checksum on the other end matches the local
+    # hashes, which get worked out in the background while the files are on their way. Nothing
+    # gets deleted until then.
+    verify = not dry_run and is_remote(remote_options) and remote_options.get('checksum', True)
+    if verify:
+        # bundled files get hashed on their way into the stream, and chunked ones alongside their chunks
+        algorithm = resolve_algorithm(remote_options.get('hash'))
+        chunked = [f for f in payload if use_chunks(f, remote_options)]
+        digests = {f: hash_async(f, algorithm) for f in payload + payload_json if f not in bundled + chunked}
+    file_delete = delete and not verify
+
+    # files may go out on other threads, they keep the manifest's tags
+    trace_tags = tracing.current_tags()
+
+    def copy_file(f):
+        with tracing.tags(**trace_tags), tracing.span('copy', file=os.path.basename(f), bytes=os.path.getsize(f)):
+            return transfer_file(f, new_path, remote_options, dry_run, file_delete, host_jobs=host_jobs,
+                                 journal=journal, proc=proc, verify_later=verify, codec=codecs[f])
+
+    if is_batch(remote_options):
+        # big files go in chunks on their own, everything else in one batch
+        big_files = [f for f in payload if use_chunks(f, remote_options)]
+        small_files = [f for f in payload if f not in big_files]
+        payload = small_files + big_files
+        with tracing.span('copy batch', files=len(small_files)):
+            status = transfer_batch(small_files, new_path, remote_options, dry_run,
+                                    file_delete, host_jobs=host_jobs, journal=journal, proc=proc, verify_later=verify)
+        status += map_jobs(file_pool, copy_file, big_files)
+    else:
+        others = [f for f in payload if f not in bundled]
+        payload = bundled + others
+        with tracing.span('copy bundle', files=len(bundled)):
+            status = transfer_bundle(bundled, new_path, remote_options, dry_run, file_delete, host_jobs=host_jobs,
+                                     journal=journal, proc=proc, verify_later=verify)
+        status += map_jobs(file_pool, copy_file, others)
+
+    if verify:
+        digests.update({f: hash_async(f, algorithm) for f in bundled + chunked})
+        status = verify_remote(payload, status, new_path, remote_options, digests, delete, host_jobs=host_jobs,
+                               journal=journal, proc=proc, codecs=codecs)
+    proc_count += status.count(True)
+
+    if status.count(False) > 0:
+        logging.info('Not sending json, ' + str(status.count(False)) + ' files failed')
+    else:
+        if is_batch(remote_options):
+            with tracing.span('copy batch', files=len(payload_json)):
+                status = transfer_batch(payload_json, new_path, remote_options, dry_run, file_delete,
+                                        host_jobs=host_jobs, journal=journal, proc=proc, verify_later=verify)
+        else:
+            status = [copy_file(f) for f in payload_json]
+        if verify:
+            status = verify_remote(payload_json, status, new_path, remote_options, digests, delete,
+                                   host_jobs=host_jobs, journal=journal, proc=proc, codecs=codecs)
+        proc_count += status.count(True)
+        if delete and status.count(False) == 0:
+            for f in [f for f in listing_manifest if f in present and f.endswith('.json')]:
+                logging.info('Already at destination, deleting ' + f)
+                os.remove(f)
+
+    if journal is not None and not dry_run and not already_triggered and status.count(False) == 0:
+        set_manifest_status(journal, proc, json_file, new_path, 'verified')
+
+    if not dry_run and status.count(False) == 0:
+        metrics.inc('dassort_sessions_total', status='copied')
+    elif not dry_run:
+        metrics.inc('dassort_sessions_total', status='failed')
+
+    outcome[proc] = 'done' if status.count(False) == 0 else 'failed'
+
+    # triggers only go out for manifests that made it, otherwise a trigger that works would count as
+    # the manifest going through
+    if outcome[proc] == 'failed':
+        return proc_count
+
+    # aiight dawg, one trigger per manifest?
+
+    issue_options = {
+        'user': '',
+        'host': '',
+        'cmd_host': '',
+        'path': ''
+    }
 
-        for ext, cmd in zip(use_dict['command']['exts'], cycle(use_dict['command']['run'])):
-            triggers = [f for f in listing_manifest if f.endswith(ext)]
-            if triggers and not dry_run and not delete:
-                raise NameError(
-                    "Delete option must be turned on, otherwise triggers will repeat")
-            elif triggers and remote_options['copy_protocol'] == 'nocopy':
-                logging.info('nocopy, doing nothing')
-            elif triggers and not dry_run:
-                issue_options['path'] = os.path.join(
-                    new_path, os.path.basename(triggers[0]))
-                issue_options = merge_dicts(issue_options, remote_options)
-                issue_cmd = build_path(issue_options, cmd)
-                logging.info('Issuing command ' + issue_cmd)
-                status = os.system(issue_cmd)
-                if status == 0:
-                    logging.info('Command SUCCESS')
-                else:
-                    logging.info('Command FAIL')
-            elif triggers:
-                issue_options['path'] = os.path.join(
-                    new_path, os.path.basename(triggers[0]))
-                issue_options = merge_dicts(issue_options, remote_options)
-                issue_cmd = build_path(issue_options, cmd)
-                logging.info('Would issue command ' + issue_cmd)
+    if already_triggered:
+        logging.info('Commands already issued for ' + proc + ', skipping')
+        return proc_count
+
+    issue_cmds = []
+
+    for ext, cmd in zip(base_dict['command']['exts'], cycle(base_dict['command']['templates'])):
+        triggers = [f for f in listing_manifest if f.endswith(ext)]
+        if triggers and not dry_run and not delete and journal is None:
+            raise NameError(
+                "Delete option must be turned on, otherwise triggers will repeat")
+        elif triggers and remote_options['copy_protocol'] == 'nocopy':
+            logging.info('nocopy, doing nothing')
+        elif triggers and not dry_run:
+            # the trigger gets the file under the name it's stored as
+            issue_options['path'] = os.path.join(
+                new_path, stored_name(triggers[0], codecs[triggers[0]], remote_options))
+            issue_options = merge_dicts(issue_options, remote_options)
+            issue_cmds.append(render_template(cmd, issue_options))
+        elif triggers:
+            issue_options['path'] = os.path.join(
+                new_path, stored_name(triggers[0], codecs[triggers[0]], remote_options))
+            issue_options = merge_dicts(issue_options, remote_options)
+            issue_cmd = render_template(cmd, issue_options)
+            logging.info('Would issue command ' + issue_cmd)
+
+    if len(issue_cmds) == 0:
+        return proc_count
+
+    # triggers from the last pass may still be going, don't send them twice
+    if any([trigger_pending((proc, new_path, issue_cmd)) for issue_cmd in issue_cmds]):
+        logging.info('Commands for ' + proc + ' still running, skipping')
+        if outcome[proc] == 'done':
+            outcome[proc] = 'triggering'
+        return proc_count
+
+    # commands go out in the background so the transfers keep flowing, the journal makes sure
+    # triggers only ever fire once (they only count once all of them come back fine)
+    trigger_state = {'left': len(issue_cmds), 'failed': False}
+    trigger_lock = threading.Lock()
+
+    def trigger_done(result):
+        metrics.observe('dassort_trigger_latency_seconds', result['started'] - start_time)
+        with tracing.tags(**trace_tags):
+            tracing.add_span('trigger', result['started'], result['duration'], cmd=result['cmd'],
+                             status=result['status'], attempts=result['attempts'])
+        with trigger_lock:
+            trigger_state['left'] -= 1
+            trigger_state['failed'] |= result['status'] != 'success'
+            finished = trigger_state['left'] == 0
+            failed = trigger_state['failed']
+        if finished and not failed and journal is not None:
+            set_manifest_status(journal, proc, json_file, new_path, 'triggered')
+        if finished and on_trigger is not None:
+            on_trigger(proc, not failed)
+
+    for issue_cmd in issue_cmds:
+        logging.info('Issuing command ' + issue_cmd)
+        submit_trigger(issue_cmd, key=(proc, new_path, issue_cmd), callback=trigger_done)
+
+    if outcome[proc] == 'done':
+        outcome[proc] = 'triggering'
+
+    return proc_count
+
+
+def proc_routes(routes, dry_run, delete, tracker=None, settle_time=30, jobs=1, host_jobs=None, journal=None,
+                scan=None, policy='listing', weights=None, settled=None, retries=None, retry_wait=30,
+                max_retry_wait=3600, max_attempts=5):
+    """Main processing loop across every route. Stable manifests from all routes go into one
+    queue (see scheduler.order_manifests) and share the same worker pool.
+
+    Args:
+        routes: list of dictionaries with the 'name', 'listing', 'base_dict' and 'remote_options' for each route
+        dry_run: log what we would do but don't do it
+        delete: delete files after a successful copy
+        tracker: stability tracker to keep between calls (see check_stability), if None we
+                 snapshot everything, wait settle_time once, and snapshot again
+        settle_time: how long (in seconds) a manifest must remain unchanged before we copy it
+        jobs: number of manifests (and files within a manifest) to transfer at once
+        host_jobs: maximum number of concurrent transfers per destination host
+        journal: transfer journal from open_journal, lets us skip work that's already done
+        scan: scan from scanner.scan_source for this cycle
+        policy: scheduling policy, listing, smallest or oldest
+        weights: dictionary of route name -> weight for sharing between routes
+        settled: set that manifests we're finished with (done, missing required files, empty or quarantined)
+                 get added to, so the caller can leave them alone until they change
+        retries: dictionary to keep between calls (see scheduler.retry_due), manifests that fail back off
+                 on their own instead of going again every cycle, and get quarantined after max_attempts
+        retry_wait: seconds a manifest waits after its first failure, doubles every time after that
+        max_retry_wait: longest a manifest ever waits between attempts
+        max_attempts: failures in a row before a manifest is quarantined (None or 0 to keep trying)
+    Returns:
+        proc_count: number of files copied, not counting manifests that failed
+    """
+    listing = [proc for route in routes for proc in route['listing']]
+
+    # snapshot everything at once, make sure the files are not growing...
+
+    if tracker is None:
+        # we need fresh stats after the wait, so the scan's no good to us here
+        tracker = {}
+        check_stability(tracker, listing, settle_time)
+        time.sleep(settle_time)
+        ready = check_stability(tracker, listing, settle_time)
+    else:
+        with tracing.span('stability check', sessions=len(listing)):
+            ready = check_stability(tracker, listing, settle_time, scan=scan)
+
+    # empty manifests (or ones that vanished) won't get any further until something changes
+    if settled is not None:
+        settled.update([proc for proc in listing if proc not in tracker])
+
+    # quarantined manifests get another go once somebody touches them
+    if retries is not None:
+        for proc in release_changed(retries, tracker):
+            logging.info(proc + ' changed, letting it out of quarantine')
+
+    manifests = []
+    held = 0
+    for route in routes:
+        remote_options = dict(route['remote_options'])
+        # split any bandwidth cap between the transfers that can go to the host at once, with a cap
+        # the host needs slots, or manifest and file threads together could run 2x jobs transfers
+        if host_jobs is None and remote_options.get('bwlimit'):
+            route_host_jobs = jobs
+        else:
+            route_host_jobs = host_jobs
+        remote_options['bwlimit_slots'] = route_host_jobs if route_host_jobs is not None else jobs
+        for proc in route['listing']:
+            if proc not in ready:
+                continue
+            if retries is not None and not retry_due(retries, proc):
+                held += 1
+                continue
+            snapshot = tracker[proc]['snapshot']
+            manifests.append({
+                'proc': proc,
+                'route': route['name'],
+                'base_dict': route['base_dict'],
+                'remote_options': remote_options,
+                'host_jobs': route_host_jobs,
+                'size': sum([v[0] for v in snapshot.values()]),
+                'mtime': max([v[1] for v in snapshot.values()] + [0])
+            })
+
+    if held > 0:
+        logging.info('Holding back ' + str(held) + ' failing manifests')
+
+    queue = order_manifests(manifests, policy=policy, weights=weights)
+
+    if jobs > 1 and len(queue) > 0:
+        manifest_pool = ThreadPoolExecutor(max_workers=jobs)
+        file_pool = ThreadPoolExecutor(max_workers=jobs)
+    else:
+        manifest_pool = None
+        file_pool = None
+
+    outcome = {}
+
+    def failed(proc, reason):
+        if record_failure(retries, proc, reason, retry_wait=retry_wait, max_retry_wait=max_retry_wait,
+                          max_attempts=max_attempts, snapshot=tracker[proc]['snapshot'] if proc in tracker else None):
+            logging.info('Quarantining ' + proc + ' after ' + str(max_attempts) + ' failed attempts (' + reason + ')')
+            metrics.inc('dassort_sessions_total', status='quarantined')
+
+    # why a manifest failed, if it's anything more than a transfer that didn't work
+    reasons = {}
+
+    def trigger_back(proc, success):
+        # the commands were the last thing left, so this is how the manifest turned out (as long as
+        # the transfers went through, only then does a trigger that works clear the failures)
+        if not success:
+            failed(proc, 'command trigger failed')
+        elif outcome.get(proc) in ('done', 'triggering'):
+            record_success(retries, proc)
+
+    def process(manifest):
+        proc = manifest['proc']
+        listing_manifest, json_file = ready[proc]
+        try:
+            with tracing.tags(session=proc, route=manifest['route'],
+                              protocol=manifest['remote_options']['copy_protocol']), \
+                    tracing.span('manifest', files=len(listing_manifest), bytes=manifest['size']):
+                return proc_manifest(proc, listing_manifest, json_file, manifest['base_dict'], dry_run,
+                                     delete, manifest['remote_options'], file_pool=file_pool,
+                                     host_jobs=manifest['host_jobs'], journal=journal, outcome=outcome,
+                                     on_trigger=trigger_back if retries is not None else None)
+        except Exception as error:
+            # one broken manifest shouldn't take the rest (or the daemon) down with it
+            logging.exception('Error processing ' + proc)
+            outcome[proc] = 'failed'
+            reasons[proc] = str(error) or type(error).__name__
+            return 0
+
+    try:
+        counts = map_jobs(manifest_pool, process, queue)
+    finally:
+        if manifest_pool is not None:
+            manifest_pool.shutdown()
+            file_pool.shutdown()
+
+    if settled is not None:
+        settled.update([proc for proc, result in outcome.items() if result in ('done', 'missing')])
+
+    # files from a manifest that failed don't count as progress, so a broken session can't keep
+    # the main loop from backing off
+    proc_count = sum([count for manifest, count in zip(queue, counts) if outcome.get(manifest['proc']) != 'failed'])
+
+    if retries is not None:
+        for proc, result in outcome.items():
+            if result == 'failed':
+                failed(proc, reasons.get(proc, 'transfer failed'))
+            elif result in ('done', 'missing'):
+                record_success(retries, proc)
+        # quarantined manifests sit there until the scan says they changed (see release_changed)
+        if settled is not None:
+            settled.update(quarantined(retries))
 
     return proc_count
+
+
+def proc_loop(listing, base_dict, dry_run, delete, remote_options, tracker=None, settle_time=30,
+              jobs=1, host_jobs=None, journal=None, scan=None, policy='listing'):
+    """Main processing loop for a single config
+
+    Args:
+        listing: files or directories to process
+        base_dict: configuration from read_config
+        dry_run: log what we would do but don't do it
+        delete: delete files after a successful copy
+        remote_options: remote configuration from read_config
+        tracker: stability tracker to keep between calls (see check_stability), if None we
+                 snapshot the whole listing, wait settle_time once, and snapshot again
+        settle_time: how long (in seconds) a manifest must remain unchanged before we copy it
+        jobs: number of manifests (and files within a manifest) to transfer at once
+        host_jobs: maximum number of concurrent transfers per destination host
+        journal: transfer journal from open_journal, lets us skip work that's already done
+        scan: scan from scanner.scan_source for this cycle
+        policy: scheduling policy, listing, smallest or oldest
+    Returns:
+        proc_count: number of files copied
+    """
+    routes = [{
+        'name': None,
+        'listing': listing,
+        'base_dict': base_dict,
+        'remote_options': remote_options
+    }]
+
+    return proc_routes(routes, dry_run, delete, tracker=tracker, settle_time=settle_time, jobs=jobs,
+                       host_jobs=host_jobs, journal=journal, scan=scan, policy=policy)
@@ -0,0 +1,177 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+# https://man7.org/linux/man-pages/man7/inotify.7.html
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_DELETE | IN_DELETE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def inotify_available():
+    """Can we use inotify on this platform?"""
+    return _libc is not None
+
+
+def add_watch(watcher, path):
+    """Watch a directory and all of its sub-directories
+
+    Args:
+        watcher: watcher dictionary from init_watcher
+        path: directory to watch
+    """
+    for root, dirs, _ in os.walk(path):
+        if root in watcher['paths']:
+            continue
+        wd = _libc.inotify_add_watch(watcher['fd'], os.fsencode(root), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # directory may have been moved or deleted while we were walking
+            if err not in (errno.ENOENT, errno.ENOTDIR):
+                logging.info('Could not watch ' + root + ': ' + os.strerror(err))
+            continue
+        watcher['wds'][wd] = root
+        watcher['paths'][root] = wd
+
+
+def init_watcher(source):
+    """Sets up an inotify watch on the source tree, including session sub-directories
+
+    Args:
+        source: source directory to watch, or a list of them
+    Returns:
+        watcher: dictionary with the inotify file descriptor and the watched directories
+    """
+    if not inotify_available():
+        raise OSError('inotify is not available on this platform')
+
+    fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+    if isinstance(source, str):
+        source = [source]
+
+    watcher = {
+        'fd': fd,
+        'source': source,
+        'wds': {},
+        'paths': {}
+    }
+    for use_source in source:
+        add_watch(watcher, use_source)
+    logging.info('Watching ' + str(len(watcher['wds'])) + ' directories in ' + ', '.join(source))
+
+    return watcher
+
+
+def close_watcher(watcher):
+    """Stops watching and closes the inotify file descriptor"""
+    os.close(watcher['fd'])
+    watcher['wds'] = {}
+    watcher['paths'] = {}
+
+
+def read_events(watcher):
+    """Drain the inotify queue
+
+    Args:
+        watcher: watcher dictionary from init_watcher
+    Returns:
+        changed: list of paths that changed
+    """
+    changed = []
+    while True:
+        try:
+            buf = os.read(watcher['fd'], 64 * 1024)
+        except BlockingIOError:
+            break
+        if not buf:
+            break
+
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+
+            root = watcher['wds'].get(wd)
+            if root is None:
+                continue
+
+            if mask & IN_IGNORED:
+                # watched directory went away
+                del watcher['wds'][wd]
+                watcher['paths'].pop(root, None)
+                continue
+
+            path = os.path.join(root, os.fsdecode(name)) if name else root
+            changed.append(path)
+
+            # new session directories get watched too
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                add_watch(watcher, path)
+
+    return changed
+
+
+def wait_for_events(watcher, timeout, debounce=1.0):
+    """Block until something changes in the source tree or we time out. Once something
+    happens, keep collecting events for a little while so a burst of writes only wakes
+    us up once.
+
+    Args:
+        watcher: watcher dictionary from init_watcher
+        timeout: maximum time to wait (seconds)
+        debounce: time to keep collecting events after the first one (seconds)
+    Returns:
+        changed: list of paths that changed, empty if we timed out
+    """
+    readable, _, _ = select.select([watcher['fd']], [], [], timeout)
+    if not readable:
+        return []
+
+    changed = read_events(watcher)
+    deadline = time.time() + debounce
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        readable, _, _ = select.select([watcher['fd']], [], [], remaining)
+        if not readable:
+            break
+        changed += read_events(watcher)
+
+    return changed